@@ -1,14 +1,47 @@
+import os
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from scripts.metrics import configure_logging, trace_requests
 from routes.rag import rag_router
 from routes.user_detail import user_router
+from routes.metrics import metrics_router
+from routes.health import health_router
+from scripts.container import Container
+from scripts.summarization_worker import SummarizationWorker
+from scripts.profile_worker import ProfileWorker
 
-app = FastAPI()
+configure_logging()
+logger = logging.getLogger(__name__)
 
-routers = [rag_router, user_router]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+   # clients connect on first use, the optional warmup (and index creation) runs in the background
+   container = Container()
+   app.state.container = container
+   container.start()
+   # conversation summarization runs here, off the request path
+   worker = SummarizationWorker()
+   app.state.summarization_worker = worker
+   worker.start()
+   # the LLM fallback of the user details extraction, batched across users
+   profile_worker = ProfileWorker(interval=float(os.environ.get('DETAILS_BATCH_INTERVAL', 30)))
+   app.state.profile_worker = profile_worker
+   profile_worker.start()
+   yield
+   await profile_worker.stop()
+   await worker.stop()
+   await container.close()
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(trace_requests)
+
+routers = [rag_router, user_router, metrics_router, health_router]
 for route in routers:
    app.include_router(route)
 # app.include_router(router=rag_router)
 
 if __name__ == "__main__":
    import uvicorn
-   uvicorn.run(app, host="127.0.0.1", port=8000) 
\ No newline at end of file
+   uvicorn.run(app, host="127.0.0.1", port=8000)
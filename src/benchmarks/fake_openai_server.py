@@ -0,0 +1,128 @@
+"""
+A local OpenAI-compatible chat completions server, to exercise the LLM gateway (pooling,
+adaptive concurrency limits, hedging) and the real chat model clients without an API key.
+
+It answers `POST /v1/chat/completions`, streamed or not, after a simulated generation delay.
+Requests beyond `--capacity` in flight are rejected with a 429 like a rate-limited provider,
+and a `--slow-fraction` of the requests take `--slow-latency` longer, to produce a latency tail.
+Structured-output requests get a JSON object answering "yes" to every required field.
+
+Usage (from `src/`):
+    python -m benchmarks.fake_openai_server --port 8001 --capacity 32 --slow-fraction 0.05
+    python -m benchmarks.run --llm-server http://127.0.0.1:8001/v1
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY = "The retrieved context explains the product, its pricing and who is eligible for it."
+
+
+def _content(body: dict) -> str:
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format.get("json_schema", {}).get("schema", {})
+        return json.dumps({name: "yes" for name in schema.get("required", [])})
+    if response_format.get("type") == "json_object":
+        return json.dumps({"binary_score": "yes"})
+    return REPLY
+
+
+def create_app(latency: float = 0.2, tokens_per_second: float = 100.0, capacity: int = 0, slow_fraction: float = 0.0, slow_latency: float = 2.0, seed: int = 0) -> FastAPI:
+    """
+    Args:
+        latency: seconds to the first token
+        tokens_per_second: generation speed after the first token
+        capacity: requests served at a time before answering 429, 0 for no limit
+        slow_fraction: share of the requests delayed by `slow_latency` more seconds
+        slow_latency: the extra delay of a slow request
+        seed: seed of the slow request draw
+    """
+    app = FastAPI()
+    rng = random.Random(seed)
+    state = {"in_flight": 0, "requests": 0, "throttled": 0}
+
+    @app.get("/stats")
+    async def stats():
+        return state
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        state["requests"] += 1
+        if capacity and state["in_flight"] >= capacity:
+            state["throttled"] += 1
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after-ms": "100"},
+                content={"error": {"message": "Rate limit reached", "type": "rate_limit_error", "code": "rate_limit_exceeded"}}
+            )
+
+        content = _content(body)
+        words = content.split(" ")
+        first_token = latency + (slow_latency if rng.random() < slow_fraction else 0.0)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model") or "fake"
+        usage = {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)}
+
+        if not body.get("stream"):
+            state["in_flight"] += 1
+            try:
+                await asyncio.sleep(first_token + len(words) / tokens_per_second)
+            finally:
+                state["in_flight"] -= 1
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage
+            }
+
+        async def events():
+            state["in_flight"] += 1
+            try:
+                await asyncio.sleep(first_token)
+                for i, word in enumerate(words):
+                    delta = {"role": "assistant", "content": word if i == 0 else " " + word}
+                    chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    await asyncio.sleep(1 / tokens_per_second)
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                state["in_flight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI-compatible chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--capacity", type=int, default=0, help="requests in flight before answering 429, 0 for no limit")
+    parser.add_argument("--slow-fraction", type=float, default=0.0, help="share of the requests that are slow")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="extra seconds of a slow request")
+    args = parser.parse_args()
+
+    app = create_app(args.latency, args.tokens_per_second, args.capacity, args.slow_fraction, args.slow_latency)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
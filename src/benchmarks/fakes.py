@@ -0,0 +1,242 @@
+"""
+In-process stand-ins for the external services of the RAG API: the chat model, the
+Pinecone retriever, MongoDB and the OpenAI client used by the chat persistence service.
+
+Each one simulates the latency of the service it replaces so the benchmark measures how
+the application schedules its calls rather than the speed of a dictionary lookup.
+"""
+import re
+import time
+import copy
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from scripts.local_vector_store import HashingEmbedder, LocalVectorStore
+from scripts.retrievers import ScoredDocument
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    A chat model answering with `respond(messages)` after a simulated generation delay of
+    `latency` seconds to the first token plus one second per `tokens_per_second` words.
+    """
+    respond: Callable[[List[BaseMessage]], str]
+    latency: float = 0.2
+    tokens_per_second: float = 100.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _delay(self, text: str) -> float:
+        return self.latency + len(text.split()) / self.tokens_per_second
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self.respond(messages)
+        time.sleep(self._delay(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self.respond(messages)
+        await asyncio.sleep(self._delay(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+class FakeRetriever:
+    """
+    An in-memory stand-in for `PineconeEmbeddingManager`: a hashing-embedder vector store
+    behind simulated embedding and query round-trips.
+    """
+    def __init__(self, corpus: Dict[str, str], embed_latency: float = 0.03, query_latency: float = 0.02):
+        self.embed_latency = embed_latency
+        self.query_latency = query_latency
+        self._embedder = HashingEmbedder()
+        # like the Pinecone manager, query embeddings are cached and only misses pay the round-trip
+        self.store = LocalVectorStore(embedder=self._remote_embed)
+        self.query_cache = self.store.query_cache
+        ids = list(corpus)
+        texts = [corpus[id_] for id_ in ids]
+        self.store.upsert(ids, self._embedder(texts), texts)
+
+    def _remote_embed(self, texts: List[str], input_type: str = "passage") -> List[List[float]]:
+        time.sleep(self.embed_latency)
+        return self._embedder(texts, input_type)
+
+    def embed(self, texts: List[str], input_type: str = "passage") -> List[List[float]]:
+        return self.store.embed(texts, input_type=input_type)
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str]) -> int:
+        return self.store.upsert(ids, vectors, texts)
+
+    def query(self, vector: List[float], top_k: int = 3) -> List[ScoredDocument]:
+        time.sleep(self.query_latency)
+        return self.store.query(vector, top_k=top_k)
+
+    def search_matching(self, query: str, top_k: int = 3, **kwargs) -> List[ScoredDocument]:
+        return self.query(self.embed([query], input_type="query")[0], top_k=top_k)
+
+    async def asearch_matching(self, query: str, top_k: int = 3, **kwargs) -> List[ScoredDocument]:
+        return await asyncio.to_thread(self.search_matching, query, top_k)
+
+
+def _matches(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(document, branch) for branch in condition):
+                return False
+            continue
+        value = document.get(key)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, operand in condition.items():
+                if op == "$exists" and (key in document) != operand:
+                    return False
+                if op == "$gte" and not (value is not None and value >= operand):
+                    return False
+                if op == "$lt" and not (value is not None and value < operand):
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _parent(document: dict, key: str):
+    """
+    The dict holding the last part of a dotted `key` and that part, creating the dicts on the way like `$set`.
+    """
+    *path, last = key.split(".")
+    for part in path:
+        document = document.setdefault(part, {})
+    return document, last
+
+
+def _project(document: Optional[dict], projection: Optional[dict]) -> Optional[dict]:
+    if document is None:
+        return None
+    document = copy.deepcopy(document)
+    if projection:
+        keep_id = projection.get("_id", 1)
+        document = {key: value for key, value in document.items() if projection.get(key) or (key == "_id" and keep_id)}
+    return document
+
+
+class _Cursor:
+    def __init__(self, documents: List[dict]):
+        self.documents = documents
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        return self.documents if length is None else self.documents[:length]
+
+
+class FakeMongoCollection:
+    """
+    An in-memory async collection implementing the subset of the pymongo API (filters,
+    update operators, upserts and projections) used by the chat persistence service and
+    the summarization worker. Every call waits `latency` seconds.
+    """
+    def __init__(self, latency: float = 0.002):
+        self.latency = latency
+        self.documents: List[dict] = []
+        self._next_id = 1
+        self.calls = 0
+
+    async def _round_trip(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    def _apply(self, document: dict, update: dict, inserted: bool):
+        for key, value in update.get("$set", {}).items():
+            parent, last = _parent(document, key)
+            parent[last] = copy.deepcopy(value)
+        for key, value in update.get("$inc", {}).items():
+            document[key] = document.get(key, 0) + value
+        for key, value in update.get("$push", {}).items():
+            document.setdefault(key, []).append(copy.deepcopy(value))
+        for key in update.get("$unset", {}):
+            *path, last = key.split(".")
+            parent = document
+            for part in path:
+                parent = parent.get(part) if isinstance(parent, dict) else None
+            if isinstance(parent, dict):
+                parent.pop(last, None)
+        if inserted:
+            for key, value in update.get("$setOnInsert", {}).items():
+                document[key] = copy.deepcopy(value)
+
+    def _find(self, query: dict, sort=None) -> List[dict]:
+        found = [document for document in self.documents if _matches(document, query)]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda document: document.get(key), reverse=direction < 0)
+        return found
+
+    def _update(self, query: dict, update: dict, upsert: bool, sort=None) -> Optional[dict]:
+        found = self._find(query, sort)
+        if found:
+            self._apply(found[0], update, inserted=False)
+            return found[0]
+        if not upsert:
+            return None
+        document = {key: value for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+        document["_id"] = self._next_id
+        self._next_id += 1
+        self._apply(document, update, inserted=True)
+        self.documents.append(document)
+        return document
+
+    async def find_one(self, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        await self._round_trip()
+        found = self._find(query)
+        return _project(found[0] if found else None, projection)
+
+    def find(self, query: dict, projection: Optional[dict] = None) -> _Cursor:
+        self.calls += 1
+        return _Cursor([_project(document, projection) for document in self._find(query)])
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: Optional[dict] = None, upsert: bool = False, return_document=None, sort=None) -> Optional[dict]:
+        await self._round_trip()
+        return _project(self._update(query, update, upsert, sort), projection)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        await self._round_trip()
+        self._update(query, update, upsert)
+
+    async def delete_one(self, query: dict):
+        await self._round_trip()
+        found = self._find(query)
+        if found:
+            self.documents.remove(found[0])
+
+    async def create_index(self, *args, **kwargs):
+        await self._round_trip()
+
+
+class FakeOpenAI:
+    """
+    Stands in for the `AsyncOpenAI` client of the chat persistence service (summaries and
+    user details), answering every completion with `reply` after `latency` seconds.
+    """
+    def __init__(self, latency: float = 0.3, reply: str = "The user asked about the company and its products."):
+        self.latency = latency
+        self.reply = reply
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.reply))])
+
+
+class WhitespaceEncoding:
+    """
+    Approximates a tokenizer by splitting on whitespace, used when tiktoken cannot fetch its ranks offline.
+    """
+    def encode(self, text: str, **kwargs) -> List[str]:
+        return re.findall(r"\S+", text)
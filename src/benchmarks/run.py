@@ -0,0 +1,365 @@
+"""
+End-to-end benchmark of the RAG API with its external services replaced by the stand-ins
+of `benchmarks.fakes`.
+
+The FastAPI app is driven in process through `httpx.ASGITransport`, so a run measures the
+request path (graph, persistence, caches) under concurrency without spending API budget.
+Every scenario reports latency percentiles, throughput and per-request counts taken from
+the Prometheus metrics, and the whole run is written as JSON so it can be compared with
+an earlier one through `--baseline`.
+
+Scenarios:
+    relevant      questions the corpus answers, the grader accepts the retrieved chunks
+    irrelevant    off-corpus questions, every chunk is rejected and the question is rewritten
+    long_history  users whose history is past the summarization threshold
+
+Usage (from `src/`):
+    python -m benchmarks.run --requests 200 --concurrency 16 --output bench.json
+
+A/B the pipeline profiles by running each with `--profile` and passing the first run as `--baseline`:
+    python -m benchmarks.run --profile two_stage --output two_stage.json
+    python -m benchmarks.run --profile fused --output fused.json --baseline two_stage.json
+
+The semantic answer cache and request coalescing are off unless `--semantic-cache` and
+`--coalesce` are passed, their hits are reported separately.
+
+To go through the real chat model clients and the LLM gateway, point `--llm-server` at a
+running `benchmarks.fake_openai_server`.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+from typing import Dict, List, Optional
+
+SCENARIOS = ["relevant", "irrelevant", "long_history"]
+
+TOPICS = [
+    "microfinance loans", "savings accounts", "mobile payments", "crop insurance", "credit scoring",
+    "merchant onboarding", "agricultural supply chains", "digital wallets", "remittance transfers",
+    "small business lending", "weather index insurance", "farmer cooperatives"
+]
+
+OFF_CORPUS_QUESTIONS = [
+    "Which volcano erupted during the eighteenth century?",
+    "Explain the rules of competitive chess openings.",
+    "Who painted the ceiling of the Sistine Chapel?",
+    "Describe the migration routes of arctic terns.",
+    "Recommend a recipe for sourdough bread."
+]
+
+def prepare_offline_environment(index_dir: str, llm_server: Optional[str] = None):
+    """
+    Point the app at offline backends before it is imported, with the startup warmup off.
+    """
+    os.environ.setdefault("API_KEY", "benchmark")
+    os.environ.setdefault("MODEL_NAME", "benchmark")
+    os.environ.setdefault("PINECONE_API_KEY", "benchmark")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["RETRIEVER_BACKEND"] = "local"
+    os.environ["LOCAL_EMBEDDER"] = "hashing"
+    os.environ["LOCAL_INDEX_PATH"] = index_dir
+    os.environ["BM25_INDEX_PATH"] = ""
+    os.environ["WARMUP_ON_STARTUP"] = "false"
+    if llm_server:
+        os.environ["LLM_BASE_URIS"] = llm_server
+
+
+def build_corpus() -> Dict[str, str]:
+    corpus = {}
+    for i, topic in enumerate(TOPICS):
+        for part in range(3):
+            corpus[f"doc-{i}-{part}"] = (
+                f"# {topic.title()}\n"
+                f"Kifiya offers {topic} to customers across the region. Section {part} explains how {topic} "
+                f"are priced, who is eligible for {topic} and how to apply for {topic} through partner branches."
+            )
+    return corpus
+
+
+def _content_words(text: str) -> set:
+    return {word for word in re.findall(r"[a-z]+", text.lower()) if len(word) > 4}
+
+
+def _human_text(messages) -> str:
+    return "\n".join(message.content for message in messages if message.type == "human")
+
+
+def grade(messages) -> str:
+    # the grader prompt ends with "User prompt: {prompt}"
+    text = _human_text(messages)
+    document, _, prompt = text.partition("User prompt:")
+    return "yes" if _content_words(document) & _content_words(prompt) else "no"
+
+
+def rewrite(messages) -> str:
+    prompt = _human_text(messages).split("Here is the initial prompt:")[-1].split("Formulate")[0]
+    return f"Detailed information about {prompt.strip()}"
+
+
+def answer(messages) -> str:
+    return " ".join(["The retrieved context explains the product, its pricing and eligibility."] * 4)
+
+
+def persona_answer(messages) -> str:
+    return " ".join(["Thanks for asking! Here is what I found for you about that."] * 5)
+
+
+class Harness:
+    """
+    Installs the stand-ins into the imported app modules and runs scenarios against the app.
+    """
+    def __init__(self, args):
+        from benchmarks.fakes import FakeChatModel, FakeMongoCollection, FakeOpenAI, FakeRetriever, WhitespaceEncoding
+        from langchain_core.output_parsers import StrOutputParser
+        from langchain_core.runnables import RunnableLambda
+        from scripts import chat_persistence_service as persistence
+        from scripts import tokens
+        from scripts.metrics import register_cache
+        from workflows import graphs
+        from workflows.models import GradeDocuments
+        from workflows.prompts import FINAL_ANSWER_PROMPT, FUSED_ANSWER_PROMPT, GRADER_PROMPT, RAG_PROMPT, REWRITER_PROMPT
+        from routes import rag
+        import app
+
+        self.args = args
+        self.persistence = persistence
+        self.tokens = tokens
+        self.app = app.app
+
+        def model(respond):
+            return FakeChatModel(respond=respond, latency=args.llm_latency, tokens_per_second=args.tokens_per_second)
+
+        graphs.manager = FakeRetriever(build_corpus(), embed_latency=args.embed_latency, query_latency=args.query_latency)
+        register_cache("query_embeddings", graphs.manager.query_cache)
+        # with --llm-server the real chains and OpenAI clients call it through the LLM gateway
+        if not args.llm_server:
+            graphs.document_grader = GRADER_PROMPT | model(grade) | RunnableLambda(lambda message: GradeDocuments(binary_score=message.content))
+            graphs.prompt_rewriter = REWRITER_PROMPT | model(rewrite) | StrOutputParser()
+            graphs.answer_generator = RAG_PROMPT | model(answer) | StrOutputParser()
+            graphs.assistant = FINAL_ANSWER_PROMPT | model(persona_answer) | StrOutputParser()
+            graphs.fused_assistant = FUSED_ANSWER_PROMPT | model(persona_answer) | StrOutputParser()
+        graphs.SPECULATIVE_REWRITE = args.speculative_rewrite
+        rag.app = graphs.build_workflow(args.profile).compile()
+        graphs.PIPELINE_PROFILE = args.profile
+        # both off by default, as in the API: concurrent repeats of a question would share one run
+        rag.COALESCE_REQUESTS = args.coalesce
+        # and the repeated questions of a scenario would mostly measure cache hits
+        rag.SEMANTIC_CACHE = args.semantic_cache
+        self.rag = rag
+
+        self.collections = {
+            "async_chat_collection": FakeMongoCollection(args.mongo_latency),
+            "async_message_collection": FakeMongoCollection(args.mongo_latency),
+            "async_job_collection": FakeMongoCollection(args.mongo_latency),
+            "async_meta_collection": FakeMongoCollection(args.mongo_latency),
+        }
+        for name, collection in self.collections.items():
+            setattr(persistence, name, collection)
+        if not args.llm_server:
+            persistence.async_ai_client = FakeOpenAI(latency=args.llm_latency)
+
+        if tokens.encoding() is None:
+            print("tiktoken ranks unavailable offline, counting whitespace-separated tokens instead", file=sys.stderr)
+            tokens.encoding = lambda: WhitespaceEncoding()
+
+    def reset(self):
+        from workflows.nodes import GRADE_CACHE
+        for collection in self.collections.values():
+            collection.documents.clear()
+            collection.calls = 0
+        self.persistence.HISTORY_CACHE.clear()
+        GRADE_CACHE.clear()
+        self.rag.ANSWER_CACHE.clear()
+
+    def questions(self, scenario: str) -> List[str]:
+        if scenario == "irrelevant":
+            return OFF_CORPUS_QUESTIONS
+        return [f"How do I apply for {topic}?" for topic in TOPICS]
+
+    async def seed_long_histories(self, users: List[str]):
+        """
+        Give every user enough history to be past the summarization threshold.
+        """
+        latencies = {name: collection.latency for name, collection in self.collections.items()}
+        for collection in self.collections.values():
+            collection.latency = 0
+        message = " ".join(["Tell me more about the savings products and loans you offer."] * 6)
+        for user_id in users:
+            tokens = 0
+            while tokens <= self.persistence.MAX_TOKEN_COUNT:
+                await self.persistence.asave_chat_message(user_id, message, message)
+                tokens += 2 * len(self.tokens.encoding().encode(message))
+        for name, collection in self.collections.items():
+            collection.latency = latencies[name]
+            collection.calls = 0
+        self.collections["async_job_collection"].documents.clear()
+
+    async def run_scenario(self, scenario: str) -> dict:
+        import httpx
+        from prometheus_client import REGISTRY
+        from scripts.summarization_worker import SummarizationWorker
+
+        self.reset()
+        args = self.args
+        users = [f"{scenario}-user-{i}" for i in range(args.users)]
+        questions = self.questions(scenario)
+        worker = None
+        if scenario == "long_history":
+            await self.seed_long_histories(users)
+            worker = SummarizationWorker(poll_interval=0.05)
+            worker.start()
+
+        def sample(name: str, labels: Optional[dict] = None) -> float:
+            return REGISTRY.get_sample_value(name, labels or {}) or 0.0
+
+        nodes = ["retrieve", "grade_documents", "rewriter", "assemble_context", "answer_generator", "assistant"]
+        before = {
+            "rewrites": sample("rag_rewrites_total"),
+            "nodes": {node: (sample("rag_node_duration_seconds_sum", {"node": node}), sample("rag_node_duration_seconds_count", {"node": node})) for node in nodes},
+        }
+        summaries_before = sample("rag_llm_duration_seconds_count", {"chain": "summary_llm"})
+        coalesced_before = sample("rag_coalesced_requests_total", {"role": "follower"})
+        cache_hits_before = self.rag.ANSWER_CACHE.hits
+
+        latencies: List[float] = []
+        errors = 0
+        semaphore = asyncio.Semaphore(args.concurrency)
+        transport = httpx.ASGITransport(app=self.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            async def request(i: int, record: bool = True):
+                nonlocal errors
+                body = {"user_id": users[i % len(users)], "question": questions[i % len(questions)]}
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.post("/rag/query", json=body)
+                    elapsed = time.perf_counter() - started
+                if not record:
+                    return
+                if response.status_code != 200:
+                    errors += 1
+                else:
+                    latencies.append(elapsed)
+
+            await asyncio.gather(*(request(i, record=False) for i in range(args.warmup)))
+            started = time.perf_counter()
+            await asyncio.gather(*(request(i) for i in range(args.requests)))
+            wall = time.perf_counter() - started
+
+        if worker is not None:
+            await worker.stop()
+
+        node_mean_ms = {}
+        for node in nodes:
+            total, count = before["nodes"][node]
+            total = sample("rag_node_duration_seconds_sum", {"node": node}) - total
+            count = sample("rag_node_duration_seconds_count", {"node": node}) - count
+            if count:
+                node_mean_ms[node] = round(1000 * total / count, 2)
+
+        total_requests = args.requests + args.warmup
+        return {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "errors": errors,
+            "latency_ms": {
+                "p50": round(1000 * percentile(latencies, 50), 2),
+                "p95": round(1000 * percentile(latencies, 95), 2),
+                "p99": round(1000 * percentile(latencies, 99), 2),
+                "mean": round(1000 * sum(latencies) / max(len(latencies), 1), 2),
+                "max": round(1000 * max(latencies, default=0.0), 2),
+            },
+            "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+            "rewrites_per_request": round((sample("rag_rewrites_total") - before["rewrites"]) / total_requests, 3),
+            "mongo_calls_per_request": round(sum(c.calls for c in self.collections.values()) / total_requests, 2),
+            "summaries": int(sample("rag_llm_duration_seconds_count", {"chain": "summary_llm"}) - summaries_before),
+            "semantic_cache_hits": self.rag.ANSWER_CACHE.hits - cache_hits_before,
+            "coalesced_requests": int(sample("rag_coalesced_requests_total", {"role": "follower"}) - coalesced_before),
+            "node_mean_ms": node_mean_ms,
+        }
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    The `q`-th percentile with linear interpolation between the closest ranks.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def compare(results: dict, baseline: dict):
+    print("\nchange against baseline (negative latency / positive throughput is better)")
+    for scenario, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(scenario)
+        if not previous:
+            continue
+        changes = []
+        for name, now, then in [
+            ("p50", current["latency_ms"]["p50"], previous["latency_ms"]["p50"]),
+            ("p95", current["latency_ms"]["p95"], previous["latency_ms"]["p95"]),
+            ("p99", current["latency_ms"]["p99"], previous["latency_ms"]["p99"]),
+            ("rps", current["throughput_rps"], previous["throughput_rps"]),
+        ]:
+            changes.append(f"{name} {100 * (now - then) / then:+.1f}%" if then else f"{name} n/a")
+        print(f"  {scenario:<13} " + " | ".join(changes))
+
+
+async def run(args) -> dict:
+    harness = Harness(args)
+    results = {"started_at": datetime.utcnow().isoformat(), "config": vars(args), "scenarios": {}}
+    for scenario in args.scenarios:
+        results["scenarios"][scenario] = stats = await harness.run_scenario(scenario)
+        latency = stats["latency_ms"]
+        print(
+            f"{scenario:<13} p50 {latency['p50']:8.1f}ms | p95 {latency['p95']:8.1f}ms | p99 {latency['p99']:8.1f}ms"
+            f" | {stats['throughput_rps']:7.1f} req/s | errors {stats['errors']}",
+            flush=True
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /rag/query against in-process stand-ins of the external services")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=100, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed requests sent before each scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--users", type=int, default=20, help="distinct users the requests are spread over")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds to the first token of every LLM call")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0, help="generation speed of the fake LLM")
+    parser.add_argument("--embed-latency", type=float, default=0.03, help="seconds per query embedding call")
+    parser.add_argument("--query-latency", type=float, default=0.02, help="seconds per vector query")
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="seconds per Mongo round-trip")
+    parser.add_argument("--profile", choices=["two_stage", "fused"], default="two_stage", help="the PIPELINE_PROFILE of the graph")
+    parser.add_argument("--coalesce", action="store_true", help="let concurrent requests for the same question share one pipeline run, reported as coalesced_requests")
+    parser.add_argument("--semantic-cache", action="store_true", help="reuse answers to similar questions, reported as semantic_cache_hits")
+    parser.add_argument("--speculative-rewrite", choices=["off", "rewrite", "retrieve"], default="off", help="the SPECULATIVE_REWRITE mode of the graph")
+    parser.add_argument("--llm-server", help="base URL of an OpenAI-compatible server (see benchmarks.fake_openai_server) to call instead of the in-process fake models")
+    parser.add_argument("--output", default=f"benchmark-{datetime.utcnow():%Y%m%d-%H%M%S}.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        prepare_offline_environment(index_dir, llm_server=args.llm_server)
+        results = asyncio.run(run(args))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
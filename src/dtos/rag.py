@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 class RAGRequest(BaseModel):
@@ -6,3 +6,16 @@ class RAGRequest(BaseModel):
     question: str = Field(
         description="The question to be answered by the RAG"
     )
+
+class RAGBatchRequest(BaseModel):
+    user_id: Optional[str] = None
+    questions: List[str] = Field(
+        description="The questions to be answered by the RAG",
+        min_length=1,
+        max_length=1000
+    )
+    max_concurrency: Optional[int] = Field(
+        default=None,
+        description="The questions answered at a time, capped by the server",
+        ge=1
+    )
@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+health_router = APIRouter(prefix="/health", tags=["health"])
+
+@health_router.get("/live")
+async def live():
+    """
+    Liveness: the process is up and serving requests.
+    """
+    return {"status": "ok"}
+
+@health_router.get("/ready")
+async def ready(request: Request):
+    """
+    Readiness: Mongo is reachable and indexed, and the warmup (when enabled) loaded the retriever and the chat model chains.
+    """
+    container = getattr(request.app.state, "container", None)
+    if container is None or container.ready:
+        return {"status": "ready"}
+    return JSONResponse(status_code=503, content={"status": "warming up", "errors": container.errors})
@@ -0,0 +1,11 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+metrics_router = APIRouter(tags=["metrics"])
+
+@metrics_router.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics of this process.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
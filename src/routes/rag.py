@@ -1,33 +1,221 @@
+import os
+import json
+import asyncio
+from typing import Dict, Hashable, Optional, Tuple
 from fastapi import APIRouter
-from dtos.rag import RAGRequest
+from fastapi.responses import StreamingResponse
+from dtos.rag import RAGBatchRequest, RAGRequest
+from workflows import graphs
 from workflows.graphs import workflow
+from workflows.batch import abatch_answer
 from langgraph.checkpoint.memory import MemorySaver 
 from langchain_core.messages import HumanMessage, AIMessage
-from scripts.chat_persistence_service import get_chat_history, save_chat_message
+from scripts.chat_persistence_service import aget_chat_history, asave_chat_message
+from scripts.cache import normalize_query
+from scripts.metrics import COALESCED_REQUESTS, register_cache
+from scripts.semantic_cache import SemanticAnswerCache
 
 # instantiate a short term memory checkpointer
 # memory = MemorySaver()
 app = workflow.compile()
 
+# answers of the RAG stage looked up by question embedding, so a near-identical question costs one embedding call.
+# only the two_stage profile produces a RAG-stage answer, with the fused profile nothing is cached.
+# off unless enabled: a similar enough question gets another question's answer
+SEMANTIC_CACHE = os.environ.get('SEMANTIC_CACHE', 'false').lower() in ('1', 'true', 'yes')
+# a cached answer is still passed through the persona with the user's own history, unless disabled
+SEMANTIC_CACHE_PERSONA = os.environ.get('SEMANTIC_CACHE_PERSONA', 'true').lower() not in ('0', 'false', 'no')
+ANSWER_CACHE = SemanticAnswerCache(
+    threshold=float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.95)),
+    maxsize=int(os.environ.get('SEMANTIC_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('SEMANTIC_CACHE_TTL', 86400))
+)
+register_cache("semantic_answers", ANSWER_CACHE)
+
+# concurrent requests for the same question share one run of the RAG stage, see `answer`; off unless enabled
+COALESCE_REQUESTS = os.environ.get('COALESCE_REQUESTS', 'false').lower() in ('1', 'true', 'yes')
+# (normalized question, corpus version) -> the RAG-stage answer of the running pipeline
+_in_flight: Dict[Tuple[str, Hashable], "asyncio.Future[Optional[str]]"] = {}
+
 
 rag_router = APIRouter(prefix='/rag', tags=['RAG'])
 
+async def _persona(question: str, user_id, history, rag_generation: str) -> str:
+    result = await graphs.aassistant_node(
+        {"generation": rag_generation, "user_id": user_id, "conversation_history": history, "prompt": question},
+        None
+    )
+    return result["generation"]
+
+def _share(shared: Optional["asyncio.Future[Optional[str]]"], rag_generation: Optional[str]):
+    if shared is not None and not shared.done():
+        shared.set_result(rag_generation)
+
+async def _run(question: str, user_id, history, shared: Optional["asyncio.Future[Optional[str]]"] = None) -> dict:
+    """
+    Answer `question` from the semantic cache when a similar question was answered, otherwise run the graph.
+    The result also carries the RAG-stage answer, None when the pipeline profile has no separate persona step.
+
+    `shared` is resolved with the RAG-stage answer as soon as it exists, before the persona step runs.
+    """
+    if SEMANTIC_CACHE:
+        version = await graphs.acorpus_version()
+        # query embeddings are cached by the retriever, a miss reuses this one for the retrieval
+        vector = (await asyncio.to_thread(graphs.manager.embed, [question], "query"))[0]
+        cached = ANSWER_CACHE.get(vector, version=version)
+        if cached is not None:
+            _share(shared, cached)
+            generation = await _persona(question, user_id, history, cached) if SEMANTIC_CACHE_PERSONA else cached
+            return {"generation": generation, "rag_generation": cached}
+
+    result = {"generation": None, "rag_generation": None}
+    # node by node, so the RAG-stage answer is known before the persona step
+    async for update in app.astream(
+        {
+            "prompt": question,
+            "user_id": user_id,
+            "conversation_history": history
+        },
+        stream_mode="updates"
+    ):
+        for values in update.values():
+            if not values:
+                continue
+            if values.get("generation") is not None:
+                result["generation"] = values["generation"]
+            if values.get("rag_generation") is not None:
+                result["rag_generation"] = values["rag_generation"]
+                _share(shared, values["rag_generation"])
+
+    if SEMANTIC_CACHE and result["rag_generation"] is not None:
+        ANSWER_CACHE.set(question, vector, result["rag_generation"], version=version)
+    return result
+
+def _settle(key, shared: "asyncio.Future[Optional[str]]", run: "asyncio.Future[dict]"):
+    """
+    Once the first request's run is over, stop sharing it and release the requests still waiting.
+    """
+    if _in_flight.get(key) is shared:
+        del _in_flight[key]
+    if shared.done():
+        return
+    if not run.cancelled() and run.exception() is not None:
+        shared.set_exception(run.exception())
+        # the waiting requests re-raise it, there may be none
+        shared.exception()
+    else:
+        # no RAG-stage answer came out, the waiting requests run the pipeline themselves
+        shared.set_result(None)
+
+async def answer(question: str, user_id, history) -> dict:
+    """
+    Answer `question`, sharing the RAG stage with a concurrent request for the same question.
+
+    The first request for a (normalized question, corpus version) runs the pipeline. Requests
+    arriving while it runs wait for its RAG-stage answer, which is shared as soon as it is
+    generated, and only run the persona step with their own history. The fused profile has
+    no separate RAG stage to share, so its requests are never coalesced.
+    """
+    if not COALESCE_REQUESTS or graphs.PIPELINE_PROFILE == "fused":
+        result = await _run(question, user_id, history)
+        return {"generation": result["generation"]}
+
+    key = (normalize_query(question), await graphs.acorpus_version())
+    shared = _in_flight.get(key)
+    if shared is None:
+        shared = asyncio.get_running_loop().create_future()
+        _in_flight[key] = shared
+        # a task of its own, so a disconnecting first client doesn't cancel the run the others wait for
+        run = asyncio.ensure_future(_run(question, user_id, history, shared))
+        run.add_done_callback(lambda _: _settle(key, shared, run))
+        COALESCED_REQUESTS.labels("leader").inc()
+        result = await asyncio.shield(run)
+        return {"generation": result["generation"]}
+
+    rag_generation = await asyncio.shield(shared)
+    if rag_generation is None:
+        COALESCED_REQUESTS.labels("uncoalesced").inc()
+        result = await _run(question, user_id, history)
+        return {"generation": result["generation"]}
+    COALESCED_REQUESTS.labels("follower").inc()
+    return {"generation": await _persona(question, user_id, history, rag_generation)}
+
+
 @rag_router.post("/query")
 async def get_response(request: RAGRequest):
 
-    history = get_chat_history(request.user_id)
+    history = await aget_chat_history(request.user_id)
 
-    result = app.invoke(
+    result = await answer(request.question, request.user_id, history)
+
+    await asave_chat_message(request.user_id, request.question, result)
+
+    return result
+
+
+@rag_router.post("/batch")
+async def batch_response(request: RAGBatchRequest):
+    """
+    Answer many questions at once, for evaluation and bulk jobs. Results come back in the order
+    of the questions, a failed question gets an `error` entry instead of failing the batch.
+    The answers are not added to the user's chat history.
+    """
+    history = await aget_chat_history(request.user_id) if request.user_id else None
+
+    results = await abatch_answer(
+        request.questions,
+        user_id=request.user_id,
+        history=history,
+        max_concurrency=request.max_concurrency,
+        graph=app
+    )
+
+    return {"results": results}
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _stream_events(request: RAGRequest, history):
+    """
+    Run the graph with LangGraph's `updates` and `messages` stream modes and relay them as server-sent events.
+
+    Emits a `node` event whenever a node finishes, a `token` event for every token of the
+    `assistant` node and a final `done` event carrying the whole answer. The answer is
+    persisted once the stream is complete.
+    """
+    generation = None
+    async for mode, chunk in app.astream(
         {
             "prompt": request.question,
             "user_id": request.user_id,
             "conversation_history": history
-        }
-    )
+        },
+        stream_mode=["updates", "messages"]
+    ):
+        if mode == "updates":
+            for node, update in chunk.items():
+                yield _sse("node", {"node": node})
+                if node == "assistant" and update:
+                    generation = update.get("generation")
+        else:
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "assistant" and message.content:
+                yield _sse("token", {"content": message.content})
 
-    save_chat_message(request.user_id, request.question, result)
+    yield _sse("done", {"generation": generation})
 
-    return result
+    await asave_chat_message(request.user_id, request.question, {"generation": generation})
+
+@rag_router.post("/query/stream")
+async def stream_response(request: RAGRequest):
+    history = await aget_chat_history(request.user_id)
+
+    return StreamingResponse(
+        _stream_events(request, history),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
     # ai_message = "AI respponse to user question"
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException
 from typing import Dict
-from scripts.chat_persistence_service import get_user_details  # Import your existing function
+from scripts.chat_persistence_service import aget_user_details
 
 user_router = APIRouter(prefix="/users", tags=["users"])
 
@@ -9,7 +9,7 @@ async def fetch_user_details(user_id: str):
     """
     Get stored details for a user (name, job, etc.).
     """
-    details = get_user_details(user_id)
+    details = await aget_user_details(user_id)
     if not details:
         raise HTTPException(status_code=404, detail="User not found")
     return details
\ No newline at end of file
@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import math
+import asyncio
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set
+from scripts.retrievers import Retriever, ScoredDocument
+from scripts.metrics import RETRIEVER_LATENCY, timed
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class BM25Index:
+    """
+    An in-process inverted index scoring documents with Okapi BM25.
+
+    Only the ids and texts are persisted, the postings are rebuilt when the index is loaded.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._lengths: List[int] = []
+        self._postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self._total_length = 0
+        self._lock = threading.Lock()
+        # of the file this index was loaded from or saved to, see `HybridRetriever.reloaded`
+        self.file_mtime: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """
+        Load an index saved with `save`. A missing file gives an empty index.
+        """
+        mtime = _mtime(path)
+        if mtime is None:
+            return cls()
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        index.add(data["ids"], data["texts"])
+        index.file_mtime = mtime
+        return index
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = {"k1": self.k1, "b": self.b, "ids": self.ids, "texts": self.texts}
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+        self.file_mtime = _mtime(path)
+
+    def _remove_postings(self, row: int):
+        for term in set(tokenize(self.texts[row])):
+            self._postings[term].pop(row, None)
+        self._total_length -= self._lengths[row]
+
+    def add(self, ids: List[str], texts: List[str]):
+        with self._lock:
+            for id_, text in zip(ids, texts):
+                row = self._rows.get(id_)
+                if row is None:
+                    row = len(self.ids)
+                    self._rows[id_] = row
+                    self.ids.append(id_)
+                    self.texts.append(text)
+                    self._lengths.append(0)
+                else:
+                    self._remove_postings(row)
+                    self.texts[row] = text
+
+                terms = tokenize(text)
+                self._lengths[row] = len(terms)
+                self._total_length += len(terms)
+                for term, frequency in Counter(terms).items():
+                    self._postings[term][row] = frequency
+
+    def prune(self, keep: Set[str]) -> int:
+        """
+        Remove the documents whose id is not in `keep`, returns the number removed.
+        """
+        with self._lock:
+            kept = [(id_, text) for id_, text in zip(self.ids, self.texts) if id_ in keep]
+            removed = len(self.ids) - len(kept)
+            if not removed:
+                return 0
+            # the postings are keyed by row, rebuild them over the kept documents
+            rebuilt = BM25Index(k1=self.k1, b=self.b)
+            rebuilt.add([id_ for id_, _ in kept], [text for _, text in kept])
+            self.ids, self.texts, self._rows = rebuilt.ids, rebuilt.texts, rebuilt._rows
+            self._lengths, self._postings, self._total_length = rebuilt._lengths, rebuilt._postings, rebuilt._total_length
+        return removed
+
+    @timed(RETRIEVER_LATENCY, "bm25_search")
+    def search(self, query: str, top_k: int = 10) -> List[ScoredDocument]:
+        with self._lock:
+            if not self.ids:
+                return []
+            average_length = self._total_length / len(self.ids) or 1.0
+            scores: Dict[int, float] = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (len(self.ids) - len(postings) + 0.5) / (len(postings) + 0.5))
+                for row, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[row] / average_length)
+                    scores[row] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+            return [{"id": self.ids[row], "text": self.texts[row], "score": score} for row, score in best]
+
+
+def reciprocal_rank_fusion(rankings: List[List[ScoredDocument]], k: int = 60) -> List[ScoredDocument]:
+    """
+    Merge ranked lists by summing 1 / (k + rank) per document.
+
+    The first ranking is the dense one: a document keeps its dense similarity as `score`
+    (None when only the other rankings found it) and its embedding, and gets the fused score as `rrf_score`.
+    """
+    fused: Dict[str, ScoredDocument] = {}
+    for position, ranking in enumerate(rankings):
+        for rank, document in enumerate(ranking, start=1):
+            entry = fused.get(document["id"])
+            if entry is None:
+                entry = {"id": document["id"], "text": document["text"], "score": document["score"] if position == 0 else None, "rrf_score": 0.0}
+                if "embedding" in document:
+                    entry["embedding"] = document["embedding"]
+                fused[document["id"]] = entry
+            entry["rrf_score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda document: document["rrf_score"], reverse=True)
+
+
+class HybridRetriever:
+    """
+    A retriever combining a dense retriever with a BM25 index over the same chunks.
+
+    Both are queried for `candidates` results which are merged with reciprocal-rank fusion,
+    so keyword-heavy questions (product names, acronyms) still find their chunks.
+    """
+    def __init__(self, dense: Retriever, lexical: BM25Index, lexical_path: Optional[str] = None, rrf_k: int = 60, candidates: int = 10):
+        self.dense = dense
+        self.lexical = lexical
+        self.lexical_path = lexical_path
+        self.rrf_k = rrf_k
+        self.candidates = candidates
+
+    def embed(self, texts: List[str], input_type: str = "passage") -> List[List[float]]:
+        return self.dense.embed(texts, input_type=input_type)
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str]) -> int:
+        self.lexical.add(ids, texts)
+        return self.dense.upsert(ids, vectors, texts)
+
+    def query(self, vector: List[float], top_k: int = 3) -> List[ScoredDocument]:
+        return self.dense.query(vector, top_k=top_k)
+
+    def prune(self, keep: Set[str]) -> int:
+        self.lexical.prune(keep)
+        prune = getattr(self.dense, "prune", None)
+        return prune(keep) if callable(prune) else 0
+
+    def reloaded(self) -> Optional["HybridRetriever"]:
+        """
+        A retriever over fresh copies of the indexes another process (the ingestion) saved
+        since they were loaded, otherwise None. Searches already running keep their indexes.
+        """
+        reload_dense = getattr(self.dense, "reloaded", None)
+        dense = reload_dense() if callable(reload_dense) else None
+        lexical = None
+        if self.lexical_path and _mtime(self.lexical_path) != self.lexical.file_mtime:
+            lexical = BM25Index.load(self.lexical_path)
+        if dense is None and lexical is None:
+            return None
+        return HybridRetriever(dense or self.dense, lexical or self.lexical, lexical_path=self.lexical_path, rrf_k=self.rrf_k, candidates=self.candidates)
+
+    def save(self):
+        save = getattr(self.dense, "save", None)
+        if callable(save):
+            save()
+        if self.lexical_path:
+            self.lexical.save(self.lexical_path)
+
+    def search_matching(self, query: str, top_k: int = 3, **kwargs) -> List[ScoredDocument]:
+        dense = self.dense.search_matching(query, top_k=max(top_k, self.candidates))
+        lexical = self.lexical.search(query, top_k=max(top_k, self.candidates))
+        return reciprocal_rank_fusion([dense, lexical], k=self.rrf_k)[:top_k]
+
+    async def asearch_matching(self, query: str, top_k: int = 3, **kwargs) -> List[ScoredDocument]:
+        dense, lexical = await asyncio.gather(
+            self.dense.asearch_matching(query, top_k=max(top_k, self.candidates)),
+            asyncio.to_thread(self.lexical.search, query, max(top_k, self.candidates))
+        )
+        return reciprocal_rank_fusion([dense, lexical], k=self.rrf_k)[:top_k]
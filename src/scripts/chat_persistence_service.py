@@ -1,92 +1,189 @@
 import os
 import re
+import json
+import logging
+import threading
 from dotenv import load_dotenv, find_dotenv
-from pymongo import MongoClient
-from openai import OpenAI
-from datetime import datetime
+from pymongo import ASCENDING, MongoClient, AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta
+from scripts.cache import TTLCache
+from scripts.container import Lazy
+from scripts import llm_gateway
+from scripts.metrics import LLM_LATENCY, MONGO_LATENCY, register_cache, span
+from scripts.tokens import count_tokens
 
 # Load environment variables
 load_dotenv(find_dotenv())
 
+logger = logging.getLogger(__name__)
+
 # Constants
-MAX_TOKEN_COUNT = 300 # Threshold for triggering summarization
+MAX_TOKEN_COUNT = int(os.environ.get('MAX_HISTORY_TOKENS', 400)) # Model tokens of unsummarized history that trigger summarization
 LAST_MESSAGES_TO_KEEP = 3  # Number of recent messages to preserve unchanged
-LLM_MODEL = "gpt-3.5-turbo"  # OpenAI model for summarization
+LLM_MODEL = os.environ.get('SUMMARY_MODEL_NAME') or os.environ.get('MODEL_NAME') or "gpt-3.5-turbo"  # model for summarization and user details
+BUCKET_SIZE = 100  # Messages per document of the chat-messages collection
+PUSH_GRACE_SECONDS = 60  # A message seq still missing from its bucket after this long is taken as lost
 
 # Database setup
+# chat-history holds one small document per user (summary, details and counters), the
+# messages themselves are appended to fixed-size buckets of chat-messages.
+# Clients are created on first use, so importing this module opens no connection
 MONGO_URI = os.environ.get('MONGO_URI')
-client = MongoClient(MONGO_URI)
-db = client["KAVAS"]
-chat_collection = db["chat-history"]
-ai_client = OpenAI(api_key=os.environ.get('API_KEY'))
+client = Lazy(lambda: MongoClient(MONGO_URI))
+db = Lazy(lambda: client["KAVAS"])
+chat_collection = Lazy(lambda: db["chat-history"])
+message_collection = Lazy(lambda: db["chat-messages"])
+ai_client = Lazy(llm_gateway.openai_client)
+
+# Async counterparts used by the FastAPI request path so Mongo and OpenAI
+# round-trips don't block the event loop
+async_client = Lazy(lambda: AsyncMongoClient(MONGO_URI))
+async_db = Lazy(lambda: async_client["KAVAS"])
+async_chat_collection = Lazy(lambda: async_db["chat-history"])
+async_message_collection = Lazy(lambda: async_db["chat-messages"])
+async_ai_client = Lazy(llm_gateway.async_openai_client)
+
+# Summarization jobs, processed off the request path by `scripts.summarization_worker`
+job_collection = Lazy(lambda: db["summarization-jobs"])
+async_job_collection = Lazy(lambda: async_db["summarization-jobs"])
+
+# Shared metadata such as the corpus version, see `scripts.corpus_version`
+meta_collection = Lazy(lambda: db["metadata"])
+async_meta_collection = Lazy(lambda: async_db["metadata"])
+
+# Write-through cache of per-user conversation state, keyed by user_id. Every write bumps
+# the document `version`, so an entry that missed a write from another process is detected
+# on the next save and dropped; the TTL bounds how long such an entry can be served.
+HISTORY_CACHE = TTLCache(
+    maxsize=int(os.environ.get('HISTORY_CACHE_SIZE', 4096)),
+    ttl=float(os.environ.get('HISTORY_CACHE_TTL', 300))
+)
+register_cache("chat_history", HISTORY_CACHE)
+_history_cache_lock = threading.Lock()
+
+# Only the users waiting for the LLM details fallback are indexed, so the worker's claims
+# don't scan the collection. The lease is the key, the pending messages are left out of it
+_PENDING_DETAILS_INDEX = {
+    'name': 'details_pending_lease',
+    'partialFilterExpression': {'details_pending': {'$exists': True}}
+}
+
+def ensure_indexes():
+    """
+    Create the collection indexes. Idempotent, called at startup.
+    """
+    chat_collection.create_index("user_id", unique=True)
+    chat_collection.create_index("user_details.name")  # For quick name searches
+    chat_collection.create_index("details_lease", **_PENDING_DETAILS_INDEX)
+    message_collection.create_index([("user_id", ASCENDING), ("bucket", ASCENDING)], unique=True)
+
+async def aensure_indexes():
+    """
+    Async version of `ensure_indexes`.
+    """
+    await async_chat_collection.create_index("user_id", unique=True)
+    await async_chat_collection.create_index("user_details.name")
+    await async_chat_collection.create_index("details_lease", **_PENDING_DETAILS_INDEX)
+    await async_message_collection.create_index([("user_id", ASCENDING), ("bucket", ASCENDING)], unique=True)
 
-# Create indexes (run once during setup)
-# chat_collection.create_index("user_id", unique=True)
-# chat_collection.create_index("user_details.name")  # For quick name searches
+def count_message_tokens(msg):
+    """
+    Tokens of a single message, see `scripts.tokens`.
+    """
+    user_message = msg.get("user_message", "")  # Default to empty string if missing
+    ai_message = msg.get("ai_message", "")
+    if not (isinstance(user_message, str) and isinstance(ai_message, str)):
+        return 0
+    return count_tokens(user_message) + count_tokens(ai_message)
 
 def get_token_count(messages):
     """
-    Calculate the token count of messages.
+    Calculate the token count of messages, using the count cached on each message when present.
     """
-    total_token_count = 0
-    for msg in messages:
-        user_message = msg.get("user_message", "")  # Default to empty string if missing
-        ai_message = msg.get("ai_message", "")
+    return sum(msg["token_count"] if "token_count" in msg else count_message_tokens(msg) for msg in messages)
+
+DETAILS_SYSTEM_PROMPT = (
+    "For each numbered conversation, extract ONLY the user's 1) full name and 2) job title. "
+    'Answer with a JSON object {"users": [{"id": <number>, "name": "<name or empty>", "job": "<job or empty>"}]}'
+)
+SUMMARY_SYSTEM_PROMPT = "Summarize this conversation concisely:"
+
+# Case-sensitive patterns, for proper nouns
+NAME_PATTERNS = [
+    re.compile(r"(?:my name is|i'm called|call me) ([A-Z][a-z]+(?: [A-Z][a-z]+)*)"),
+    re.compile(r"(?:i am|name's) ([A-Z][a-z]+(?: [A-Z][a-z]+)*)")
+]
+JOB_PATTERNS = [
+    re.compile(r"(?:i work as|my job is) (?:a )?([A-Z][a-z]+(?: [A-Z][a-z]+)*)"),
+    re.compile(r"(?:i'm|i am) (?:a )?([A-Z][a-z]+(?: [A-Z][a-z]+)*)(?: engineer| developer| analyst)?")
+]
+DETAILS_LLM_MESSAGES = 5  # user messages handed to the LLM fallback
+DETAILS_BATCH_SIZE = int(os.environ.get('DETAILS_BATCH_SIZE', 20))  # users per LLM fallback call
+DETAILS_MAX_ATTEMPTS = 3  # failed LLM fallbacks after which a user's pending messages are dropped
+DETAILS_LEASE_SECONDS = 300  # how long a worker owns the users it claimed
+
+def _details_request(conversations):
+    """
+    Build the chat completion arguments for the batched details extraction fallback.
+    """
+    numbered = "\n\n".join(f"{i}:\n" + "\n".join(texts) for i, texts in enumerate(conversations, start=1))
+    return dict(
+        model=LLM_MODEL,
+        messages=[{
+            "role": "system",
+            "content": DETAILS_SYSTEM_PROMPT
+        }, {
+            "role": "user",
+            "content": numbered
+        }],
+        response_format={"type": "json_object"},
+        temperature=0,
+        # room for the id, a long name and a long job title per user
+        max_tokens=80 * len(conversations) + 50
+    )
 
-        if isinstance(user_message, str) and isinstance(ai_message, str):
-            total_token_count += len(user_message.split()) + len(ai_message.split())
-    print(total_token_count)
-    return total_token_count
+def _parse_details(content, count):
+    """
+    The {'name', 'job'} answers of a batched extraction, in the order of the conversations.
+    """
+    reply = json.loads(content or "")
+    users = reply.get("users") if isinstance(reply, dict) else None
+    if not isinstance(users, list):
+        raise ValueError(f"unexpected details reply: {content[:200]!r}")
+    results = [{} for _ in range(count)]
+    for user in users:
+        if not isinstance(user, dict):
+            continue
+        try:
+            i = int(user.get("id")) - 1
+        except (TypeError, ValueError):
+            continue
+        if 0 <= i < count:
+            results[i] = {key: str(user[key]).strip() for key in ("name", "job") if user.get(key)}
+    return results
 
-def extract_details_via_llm(recent_messages):
+async def aextract_details_via_llm(conversations):
     """
-    Fallback LLM extraction when pattern matching fails.
+    Fallback LLM extraction when pattern matching fails, for many users in one call.
     Args:
-        recent_messages: List of the last 5 message dicts
+        conversations: one list of user message texts per user
     Returns:
-        str: Formatted "Name: X; Job: Y" or empty string
+        list: {'name': str, 'job': str} per user (missing keys if not found)
     """
-    print('Extracting details via LLM')
-    conversation = "\n".join(msg.get("user_message", "") for msg in recent_messages)
-    try:
-        response = ai_client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[{
-                "role": "system",
-                "content": "Extract ONLY: 1) Full name, 2) Job title. Return as 'Name: X; Job: Y' or ''"
-            }, {
-                "role": "user",
-                "content": conversation
-            }],
-            temperature=0,
-            max_tokens=50
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"LLM extraction failed: {e}")
-        return ""
+    logger.debug('Extracting details of %d users via LLM', len(conversations))
+    with span(LLM_LATENCY, "details_llm"):
+        response = await async_ai_client.chat.completions.create(**_details_request(conversations))
+    return _parse_details(response.choices[0].message.content, len(conversations))
 
-def extract_user_details(messages):
+def _match_user_details(messages):
     """
-    Extract name and job using regex patterns with LLM fallback.
-    Improved to prevent duplicate values and better pattern matching.
+    Extract name and job using the precompiled patterns only.
     Args:
         messages: List of message dicts
     Returns:
         dict: {'name': str, 'job': str} (missing keys if not found)
     """
-    print('Extracting user details')
-    patterns = {
-        "name": [
-            r"(?:my name is|i'm called|call me) ([A-Z][a-z]+(?: [A-Z][a-z]+)*)",
-            r"(?:i am|name's) ([A-Z][a-z]+(?: [A-Z][a-z]+)*)"
-        ],
-        "job": [
-            r"(?:i work as|my job is) (?:a )?([A-Z][a-z]+(?: [A-Z][a-z]+)*)",
-            r"(?:i'm|i am) (?:a )?([A-Z][a-z]+(?: [A-Z][a-z]+)*)(?: engineer| developer| analyst)?"
-        ]
-    }
-    
     details = {}
     
     for msg in messages:
@@ -94,16 +191,15 @@ def extract_user_details(messages):
         if not text:
             continue
             
-        # Case-sensitive matching for proper nouns
         if "name" not in details:
-            for pattern in patterns["name"]:
-                if match := re.search(pattern, text):
+            for pattern in NAME_PATTERNS:
+                if match := pattern.search(text):
                     details["name"] = match.group(1)
                     break
                     
         if "job" not in details:
-            for pattern in patterns["job"]:
-                if match := re.search(pattern, text):
+            for pattern in JOB_PATTERNS:
+                if match := pattern.search(text):
                     # Additional validation to prevent name being captured as job
                     job = match.group(1)
                     if "name" in details and job == details["name"]:
@@ -111,29 +207,62 @@ def extract_user_details(messages):
                     details["job"] = job
                     break
     
-    # LLM fallback with duplicate prevention
-    if (not details or 
-        ("name" in details and "job" in details and details["name"] == details["job"])):
-        if llm_result := extract_details_via_llm(messages[-5:]):
-            if "Name:" in llm_result and "Job:" in llm_result:
-                name = llm_result.split("Name:")[-1].split(";")[0].strip()
-                job = llm_result.split("Job:")[-1].strip()
-                if name != job:  # Only use if they're different
-                    details.update({"name": name, "job": job})
+    return details
+
+def _merge_details(details, found):
+    """
+    Merge newly found details into the stored ones and drop duplicates.
+    """
+    details = {**details, **{key: value for key, value in found.items() if value}}
     
     # Final validation
     if "name" in details and "job" in details and details["name"] == details["job"]:
         del details["job"]  # Remove duplicate value
-    print(details)
+    logger.debug("Extracted details: %s", details)
     return details
 
-def summarize_conversation(messages):
+def _details_fields(stored, details):
     """
-    Robust summarization with proper type checking
+    The `$set` and `$unset` fields turning the `stored` user details into `details`, one per
+    changed key, so keys saved meanwhile by another writer are left alone.
+    """
+    changed = {f'user_details.{key}': value for key, value in details.items() if stored.get(key) != value}
+    removed = {f'user_details.{key}': '' for key in stored if key not in details}
+    return changed, removed
+
+def extract_user_details(user_doc, messages):
+    """
+    Update the stored user details from the messages not scanned yet.
+
+    Only messages at or past the `details_count` watermark are matched, so every message is
+    scanned once however often the history is summarized. When the patterns find nothing
+    and the profile is incomplete, the last user messages are returned for the batched LLM
+    fallback run by `scripts.profile_worker` instead of calling the LLM here.
+    Args:
+        user_doc: the user document
+        messages: the unsummarized messages, with their `seq`
+    Returns:
+        tuple: (details dict, watermark, user message texts for the LLM fallback or None)
+    """
+    logger.debug('Extracting user details')
+    scanned = user_doc.get('details_count', 0)
+    new_messages = [msg for msg in messages if msg['seq'] >= scanned]
+    details = user_doc.get('user_details', {})
+    if not new_messages:
+        return details, scanned, user_doc.get('details_pending')
+
+    found = _match_user_details(new_messages)
+    details = _merge_details(details, found)
+    pending = None
+    if not found and not ("name" in details and "job" in details):
+        texts = [msg.get("user_message", "") for msg in new_messages if msg.get("user_message")]
+        pending = texts[-DETAILS_LLM_MESSAGES:] or None
+    return details, new_messages[-1]['seq'] + 1, pending
+
+def _summary_request(messages):
+    """
+    Build the chat completion arguments for summarizing the given messages.
     """
-    if not messages:
-        return "No messages to summarize", []
-    
     # Process messages with type safety
     processed_messages = []
     for msg in messages:
@@ -155,33 +284,61 @@ def summarize_conversation(messages):
             }
             processed_messages.append(chunk)
     
+    conversation_text = "\n".join(
+        f"User: {msg['user_message']}\nAI: {msg['ai_message']}" 
+        for msg in processed_messages
+    )[:8000]  # Stay within context limits
+
+    return dict(
+        model=LLM_MODEL,
+        messages=[{
+            "role": "system",
+            "content": SUMMARY_SYSTEM_PROMPT
+        }, {
+            "role": "user",
+            "content": conversation_text
+        }],
+        temperature=0.2,
+        max_tokens=200
+    )
+
+def summarize_conversation(messages):
+    """
+    Robust summarization with proper type checking
+    """
+    if not messages:
+        return "No messages to summarize", []
+    
     try:
         # Generate summary
-        conversation_text = "\n".join(
-            f"User: {msg['user_message']}\nAI: {msg['ai_message']}" 
-            for msg in processed_messages
-        )[:8000]  # Stay within context limits
-        
-        response = ai_client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[{
-                "role": "system",
-                "content": "Summarize this conversation concisely:"
-            }, {
-                "role": "user",
-                "content": conversation_text
-            }],
-            temperature=0.2,
-            max_tokens=200
-        )
+        with span(LLM_LATENCY, "summary_llm"):
+            response = ai_client.chat.completions.create(**_summary_request(messages))
         return response.choices[0].message.content.strip(), messages[-LAST_MESSAGES_TO_KEEP:]
     except Exception as e:
-        print(f"Summarization error: {e}")
+        logger.warning("Summarization error: %s", e)
         return "Conversation summary unavailable", messages[-LAST_MESSAGES_TO_KEEP:]
 
+async def asummarize_conversation(messages):
+    """
+    Async version of `summarize_conversation`.
+    """
+    if not messages:
+        return "No messages to summarize", []
+    
+    try:
+        # Generate summary
+        with span(LLM_LATENCY, "summary_llm"):
+            response = await async_ai_client.chat.completions.create(**_summary_request(messages))
+        return response.choices[0].message.content.strip(), messages[-LAST_MESSAGES_TO_KEEP:]
+    except Exception as e:
+        logger.warning("Summarization error: %s", e)
+        return "Conversation summary unavailable", messages[-LAST_MESSAGES_TO_KEEP:]
 
-def save_chat_message(user_id, user_message, ai_message):
-    """With enhanced type safety"""
+
+def _build_message(user_message, ai_message):
+    """
+    Normalize a question/answer pair into the stored message format.
+    """
     timestamp = datetime.utcnow().isoformat()
     
     # Ensure messages are strings
@@ -189,97 +346,406 @@ def save_chat_message(user_id, user_message, ai_message):
     ai_message = str(ai_message.get('generation', ai_message) if isinstance(ai_message, dict) else str(ai_message))
     ai_message = ai_message[:2000]
     
-    new_message = {
+    message = {
         'user_message': user_message,
         'ai_message': ai_message,
         'timestamp': timestamp
     }
+    message['token_count'] = count_message_tokens(message)
+    return message
 
-    # Rest of your save logic remains the same...
+def _all_messages(user_chat):
+    """
+    Every unsummarized message of a chat document, oldest first.
+    """
+    return user_chat.get('recent_messages', []) + (user_chat.get('conversation_history') or [])
 
-    user_chat = chat_collection.find_one({'user_id': user_id})
-    
+def _truncate_messages(messages):
+    """
+    Truncate messages before storing them as the recent window.
+    """
+    truncated_messages = []
+    for msg in messages:
+        truncated_msg = {
+            'user_message': msg['user_message'][:500],  # Truncate to 500 chars
+            'ai_message': msg['ai_message'][:500],
+            'timestamp': msg['timestamp']
+        }
+        truncated_msg['token_count'] = count_message_tokens(truncated_msg)
+        truncated_messages.append(truncated_msg)
+    return truncated_messages
+
+def _append_update(new_message):
+    """
+    The user document update counting a new message and adding its tokens to the running total.
+    """
+    timestamp = new_message['timestamp']
+    return {
+        '$inc': {'message_count': 1, 'token_count': new_message['token_count'], 'version': 1},
+        '$set': {'last_updated': timestamp},
+        '$setOnInsert': {'created_at': timestamp}
+    }
+
+# only the counters are read back, so a save costs the same however long the history is
+_COUNTERS_PROJECTION = {'message_count': 1, 'token_count': 1, 'version': 1, '_id': 0}
+
+def _bucket_push(user_id, new_message):
+    """
+    The filter and update appending a numbered message to its bucket.
+    """
+    return (
+        {'user_id': user_id, 'bucket': new_message['seq'] // BUCKET_SIZE},
+        {'$push': {'messages': new_message}}
+    )
+
+def _unsummarized_buckets(user_id, user_doc):
+    """
+    The query for the buckets holding messages newer than the summarization watermark.
+    """
+    watermark = user_doc.get('summarized_count', 0)
+    return {'user_id': user_id, 'bucket': {'$gte': watermark // BUCKET_SIZE}}
+
+_BUCKET_PROJECTION = {'messages': 1, '_id': 0}
+
+def _assemble_chat(user_doc, buckets):
+    """
+    The user document with its unsummarized messages, oldest first, as `conversation_history`.
+    """
+    watermark = user_doc.get('summarized_count', 0)
+    messages = [msg for bucket in buckets for msg in bucket['messages'] if msg['seq'] >= watermark]
+    # concurrent saves can push to a bucket out of order
+    messages.sort(key=lambda msg: msg['seq'])
+    user_doc.pop('_id', None)
+    return {**user_doc, 'conversation_history': messages}
+
+def _contiguous(messages, watermark):
+    """
+    The leading messages whose seqs follow on from `watermark` without a gap.
+
+    A save allocates its seq before pushing the message to its bucket, so a missing seq can
+    be a message that is still on its way. The run only continues past a gap once the
+    message after it is older than PUSH_GRACE_SECONDS, the missing one is then taken as lost.
+    """
+    cutoff = (datetime.utcnow() - timedelta(seconds=PUSH_GRACE_SECONDS)).isoformat()
+    expected = watermark
+    run = []
+    for msg in messages:
+        if msg['seq'] != expected and msg['timestamp'] > cutoff:
+            break
+        run.append(msg)
+        expected = msg['seq'] + 1
+    return run
+
+def _cache_chat(user_id, user_chat):
     if user_chat:
-        # Get all existing messages
-        all_messages = user_chat.get('conversation_history', [])
-        if 'recent_messages' in user_chat:
-            all_messages.extend(user_chat['recent_messages'])
-        
-        # Add new message
-        all_messages.append(new_message)
-        
-        # Calculate tokens
-        total_tokens = get_token_count(all_messages)
-        print(f"Total tokens: {total_tokens} (Threshold: {MAX_TOKEN_COUNT})")
-        
-        if total_tokens > MAX_TOKEN_COUNT:
-            # Summarize all except last N messages
-            to_summarize = all_messages[:-LAST_MESSAGES_TO_KEEP]
-            recent_messages = all_messages[-LAST_MESSAGES_TO_KEEP:]
-            
-            # Truncate recent messages before storing
-            truncated_recent_messages = []
-            for msg in recent_messages:
-                truncated_msg = {
-                    'user_message': msg['user_message'][:500],  # Truncate to 500 chars
-                    'ai_message': msg['ai_message'][:500],
-                    'timestamp': msg['timestamp']
-                }
-                truncated_recent_messages.append(truncated_msg)
-            
-            summary = summarize_conversation(to_summarize)
-            user_details = extract_user_details(all_messages)
-            
-            # Update database with truncated recent messages
-            chat_collection.update_one(
-                {'user_id': user_id},
-                {'$set': {
+        HISTORY_CACHE.set(user_id, user_chat)
+
+def _cache_append(user_id, new_message, user_chat):
+    """
+    Apply a saved message to the cached state, or drop the entry when it missed another write.
+    """
+    version = user_chat['version']
+    with _history_cache_lock:
+        # version 1 means the save created the document
+        cached = {} if version == 1 else HISTORY_CACHE.get(user_id)
+        if cached is None or cached.get('version', 0) != version - 1:
+            HISTORY_CACHE.pop(user_id)
+            return
+        HISTORY_CACHE.set(user_id, {
+            **cached,
+            'conversation_history': (cached.get('conversation_history') or []) + [new_message],
+            'message_count': user_chat['message_count'],
+            'token_count': user_chat['token_count'],
+            'version': version,
+            'last_updated': new_message['timestamp']
+        })
+
+def invalidate_cached_history(user_id):
+    HISTORY_CACHE.pop(user_id)
+
+def _summarization_job(user_id):
+    now = datetime.utcnow()
+    # one pending job per user, later messages are coalesced into it
+    return (
+        {'user_id': user_id, 'status': 'pending'},
+        {'$inc': {'pending_messages': 1}, '$setOnInsert': {'created_at': now}}
+    )
+
+def enqueue_summarization(user_id):
+    """
+    Queue a summarization of the user's history, coalescing with an already pending job.
+    """
+    query, update = _summarization_job(user_id)
+    try:
+        with span(MONGO_LATENCY, "enqueue_summarization"):
+            job_collection.update_one(query, update, upsert=True)
+    except DuplicateKeyError:
+        # a concurrent save created the pending job first
+        with span(MONGO_LATENCY, "enqueue_summarization"):
+            job_collection.update_one(query, update)
+
+async def aenqueue_summarization(user_id):
+    """
+    Async version of `enqueue_summarization`.
+    """
+    query, update = _summarization_job(user_id)
+    try:
+        with span(MONGO_LATENCY, "enqueue_summarization"):
+            await async_job_collection.update_one(query, update, upsert=True)
+    except DuplicateKeyError:
+        with span(MONGO_LATENCY, "enqueue_summarization"):
+            await async_job_collection.update_one(query, update)
+
+def save_chat_message(user_id, user_message, ai_message):
+    """
+    Append a message to the user's history. The user document counter gives the message its
+    sequence number, which picks the bucket it is pushed to. Summarization, once the history
+    grows past MAX_TOKEN_COUNT, is queued for the background worker instead of run inline.
+    """
+    new_message = _build_message(user_message, ai_message)
+
+    with span(MONGO_LATENCY, "append_message"):
+        user_chat = chat_collection.find_one_and_update(
+            {'user_id': user_id},
+            _append_update(new_message),
+            projection=_COUNTERS_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    new_message['seq'] = user_chat['message_count'] - 1
+    with span(MONGO_LATENCY, "push_message"):
+        message_collection.update_one(*_bucket_push(user_id, new_message), upsert=True)
+
+    _cache_append(user_id, new_message, user_chat)
+    if user_chat['token_count'] > MAX_TOKEN_COUNT:
+        enqueue_summarization(user_id)
+
+async def asave_chat_message(user_id, user_message, ai_message):
+    """
+    Async version of `save_chat_message`.
+    """
+    new_message = _build_message(user_message, ai_message)
+
+    with span(MONGO_LATENCY, "append_message"):
+        user_chat = await async_chat_collection.find_one_and_update(
+            {'user_id': user_id},
+            _append_update(new_message),
+            projection=_COUNTERS_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    new_message['seq'] = user_chat['message_count'] - 1
+    with span(MONGO_LATENCY, "push_message"):
+        await async_message_collection.update_one(*_bucket_push(user_id, new_message), upsert=True)
+
+    _cache_append(user_id, new_message, user_chat)
+    if user_chat['token_count'] > MAX_TOKEN_COUNT:
+        await aenqueue_summarization(user_id)
+
+async def asummarize_user_history(user_id):
+    """
+    Summarize a user's history, run by the background worker.
+
+    Everything except the last LAST_MESSAGES_TO_KEEP messages is folded into the summary
+    (together with the previous summary) and the summarization watermark is moved past the
+    messages that were read, so messages appended while the LLM calls were running are kept.
+    Reading stops at a seq that was allocated but not pushed yet, see `_contiguous`.
+    """
+    with span(MONGO_LATENCY, "load_user"):
+        user_doc = await async_chat_collection.find_one({'user_id': user_id})
+    if not user_doc:
+        return
+    with span(MONGO_LATENCY, "load_messages"):
+        buckets = await async_message_collection.find(_unsummarized_buckets(user_id, user_doc), _BUCKET_PROJECTION).to_list(None)
+    user_chat = _assemble_chat(user_doc, buckets)
+
+    history = _contiguous(user_chat['conversation_history'], user_doc.get('summarized_count', 0))
+    all_messages = _all_messages({**user_chat, 'conversation_history': history})
+    total_tokens = get_token_count(all_messages)
+    if not history or total_tokens <= MAX_TOKEN_COUNT:
+        # an earlier job already summarized these messages
+        return
+
+    to_summarize = all_messages[:-LAST_MESSAGES_TO_KEEP]
+    recent_messages = all_messages[-LAST_MESSAGES_TO_KEEP:]
+    if 'conversation_summary' in user_chat:
+        to_summarize = [{'user_message': '', 'ai_message': f"Earlier summary: {summary_text(user_chat['conversation_summary'])}"}] + to_summarize
+
+    summary, _ = await asummarize_conversation(to_summarize)
+    user_details, details_count, details_pending = extract_user_details(user_doc, history)
+
+    # the ProfileWorker may save details while the summary is generated, only write what changed here
+    details_set, details_unset = _details_fields(user_doc.get('user_details') or {}, user_details)
+
+    recent_messages = _truncate_messages(recent_messages)
+    # tokens of messages appended meanwhile stay in the running total
+    removed_tokens = total_tokens - get_token_count(recent_messages)
+
+    watermark = {'summarized_count': user_doc['summarized_count']} if 'summarized_count' in user_doc else {'summarized_count': {'$exists': False}}
+    with span(MONGO_LATENCY, "save_summary"):
+        await async_chat_collection.update_one(
+            {'user_id': user_id, **watermark},
+            {
+                '$set': {
                     'conversation_summary': summary,
-                    'recent_messages': truncated_recent_messages,
-                    'user_details': user_details,
-                    'last_updated': timestamp
-                }, '$unset': {'conversation_history': ""}},
-                upsert=True
+                    'recent_messages': recent_messages,
+                    **details_set,
+                    'details_count': details_count,
+                    'last_updated': datetime.utcnow().isoformat(),
+                    'summarized_count': history[-1]['seq'] + 1,
+                    **({'details_pending': details_pending} if details_pending else {})
+                },
+                '$inc': {'token_count': -removed_tokens, 'version': 1},
+                # newly pending messages get their own attempts
+                '$unset': {'details_attempts': '', 'details_lease': '', **details_unset, **({} if details_pending else {'details_pending': ''})}
+            }
+        )
+    invalidate_cached_history(user_id)
+
+async def _aextract_details(conversations):
+    """
+    The LLM fallback answers of `conversations`, None for a user whose reply couldn't be read.
+    A batch whose reply isn't valid JSON (truncated or malformed) is retried in halves.
+    """
+    try:
+        return await aextract_details_via_llm(conversations)
+    except ValueError as e:
+        if len(conversations) == 1:
+            logger.warning("Unreadable user details reply: %s", e)
+            return [None]
+        logger.info("Unreadable user details reply for %d users, retrying in halves: %s", len(conversations), e)
+        half = len(conversations) // 2
+        return await _aextract_details(conversations[:half]) + await _aextract_details(conversations[half:])
+
+async def _aclaim_pending_details(limit):
+    """
+    Lease up to `limit` users waiting for the LLM fallback, so API replicas don't process the same users.
+    """
+    now = datetime.utcnow()
+    docs = []
+    for _ in range(limit):
+        with span(MONGO_LATENCY, "claim_pending_details"):
+            doc = await async_chat_collection.find_one_and_update(
+                {
+                    'details_pending': {'$exists': True},
+                    '$or': [{'details_lease': {'$exists': False}}, {'details_lease': {'$lt': now}}]
+                },
+                {'$set': {'details_lease': now + timedelta(seconds=DETAILS_LEASE_SECONDS)}},
+                projection={'user_id': 1, 'user_details': 1, 'details_pending': 1, 'details_count': 1, 'details_attempts': 1, '_id': 0},
+                return_document=ReturnDocument.AFTER
             )
+        if doc is None:
+            break
+        docs.append(doc)
+    return docs
+
+def _details_failure(doc):
+    """
+    The update recording a failed LLM fallback, dropping the pending messages after DETAILS_MAX_ATTEMPTS.
+    """
+    attempts = doc.get('details_attempts', 0) + 1
+    if attempts >= DETAILS_MAX_ATTEMPTS:
+        logger.warning("Giving up extracting the details of %s after %d attempts", doc['user_id'], attempts)
+        return {'$unset': {'details_pending': '', 'details_lease': '', 'details_attempts': ''}}
+    return {'$set': {'details_attempts': attempts}, '$unset': {'details_lease': ''}}
+
+async def aextract_pending_details(limit=DETAILS_BATCH_SIZE):
+    """
+    Run the LLM details fallback for up to `limit` users the patterns found nothing for, in one call.
+
+    The users are leased first. A user's result is only saved while their details watermark
+    is unchanged, a summarization that ran meanwhile has scanned newer messages and queued
+    them again if needed. A failed user is retried on a later run, at most DETAILS_MAX_ATTEMPTS times.
+    Returns:
+        int: the number of users processed
+    """
+    docs = await _aclaim_pending_details(limit)
+    if not docs:
+        return 0
+
+    try:
+        found = await _aextract_details([doc['details_pending'] for doc in docs])
+    except Exception as e:
+        logger.warning("LLM extraction of %d users failed: %s", len(docs), e)
+        found = [None] * len(docs)
+    for doc, details in zip(docs, found):
+        if details is None:
+            update = _details_failure(doc)
         else:
-            # Update normally
-            chat_collection.update_one(
-                {'user_id': user_id},
-                {'$set': {
-                    'conversation_history': all_messages,
-                    'last_updated': timestamp
-                }},
-                upsert=True
+            stored = doc.get('user_details') or {}
+            details_set, details_unset = _details_fields(stored, _merge_details(stored, details))
+            update = {
+                **({'$set': details_set} if details_set else {}),
+                '$unset': {'details_pending': '', 'details_lease': '', 'details_attempts': '', **details_unset},
+                '$inc': {'version': 1}
+            }
+        with span(MONGO_LATENCY, "save_user_details"):
+            await async_chat_collection.update_one(
+                {'user_id': doc['user_id'], 'details_count': doc.get('details_count', 0)},
+                update
             )
-    else:
-        # New user
-        chat_collection.insert_one({
-            'user_id': user_id,
-            'conversation_history': [new_message],
-            'created_at': timestamp,
-            'last_updated': timestamp
-        })
+        invalidate_cached_history(doc['user_id'])
+    return len(docs)
 
 
-def get_chat_history(user_id):
+def summary_text(summary):
     """
-    Retrieve conversation history with guaranteed structure
+    The stored conversation summary as a string. Documents summarized before the bucketed
+    layout hold the whole `(summary, recent_messages)` pair as an array.
+    """
+    if isinstance(summary, (list, tuple)):
+        summary = summary[0] if summary else None
+    return summary if isinstance(summary, str) else "No summary available"
+
+def _format_history(user_chat):
+    """
+    Shape a stored chat document into the history handed to the graph.
     """
-    user_chat = chat_collection.find_one({"user_id": user_id})
     if not user_chat:
         return None
     
     # Initialize response with all possible fields
     response = {
         "user_details": user_chat.get("user_details", {}),
-        "summary": user_chat.get("conversation_summary", "No summary available"),
+        "summary": summary_text(user_chat.get("conversation_summary")),
         "recent_messages": user_chat.get("recent_messages", []),
         "full_history": user_chat.get("conversation_history", []),
-        "type": "condensed" if "conversation_summary" in user_chat else "full"
+        "type": "condensed" if "conversation_summary" in user_chat else "full",
+        "version": user_chat.get("version", 0)
     }
     
     return response
 
+def get_chat_history(user_id):
+    """
+    Retrieve conversation history with guaranteed structure
+    """
+    user_chat = HISTORY_CACHE.get(user_id)
+    if user_chat is None:
+        with span(MONGO_LATENCY, "load_user"):
+            user_doc = chat_collection.find_one({"user_id": user_id})
+        if user_doc:
+            with span(MONGO_LATENCY, "load_messages"):
+                buckets = list(message_collection.find(_unsummarized_buckets(user_id, user_doc), _BUCKET_PROJECTION))
+            user_chat = _assemble_chat(user_doc, buckets)
+            _cache_chat(user_id, user_chat)
+    return _format_history(user_chat)
+
+async def aget_chat_history(user_id):
+    """
+    Async version of `get_chat_history`.
+    """
+    user_chat = HISTORY_CACHE.get(user_id)
+    if user_chat is None:
+        with span(MONGO_LATENCY, "load_user"):
+            user_doc = await async_chat_collection.find_one({"user_id": user_id})
+        if user_doc:
+            with span(MONGO_LATENCY, "load_messages"):
+                buckets = await async_message_collection.find(_unsummarized_buckets(user_id, user_doc), _BUCKET_PROJECTION).to_list(None)
+            user_chat = _assemble_chat(user_doc, buckets)
+            _cache_chat(user_id, user_chat)
+    return _format_history(user_chat)
+
 
 def get_user_details(user_id):
     """
@@ -289,8 +755,24 @@ def get_user_details(user_id):
     Returns:
         dict: {'name': str, 'job': str} (partial if some info missing)
     """
-    doc = chat_collection.find_one(
-        {"user_id": user_id},
-        {"user_details": 1}
-    )
+    doc = HISTORY_CACHE.get(user_id)
+    if doc is None:
+        with span(MONGO_LATENCY, "load_user_details"):
+            doc = chat_collection.find_one(
+                {"user_id": user_id},
+                {"user_details": 1}
+            )
+    return doc.get("user_details", {}) if doc else {}
+
+async def aget_user_details(user_id):
+    """
+    Async version of `get_user_details`.
+    """
+    doc = HISTORY_CACHE.get(user_id)
+    if doc is None:
+        with span(MONGO_LATENCY, "load_user_details"):
+            doc = await async_chat_collection.find_one(
+                {"user_id": user_id},
+                {"user_details": 1}
+            )
     return doc.get("user_details", {}) if doc else {}
@@ -0,0 +1,138 @@
+"""
+Lazily created clients and the startup/readiness state of the API.
+
+Module-level clients (Mongo, OpenAI, the chat model chains, the retriever) are declared
+as `Lazy` proxies, so importing the app makes no connection and needs no credentials:
+each client is built on first use. The `Container`, owned by the FastAPI lifespan, can
+warm them up ahead of the first request and reports readiness separately from liveness.
+"""
+import os
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Lazy:
+    """
+    A proxy building its target with `factory` on first attribute access, then forwarding to it.
+    """
+    def __init__(self, factory: Callable[[], Any]):
+        self._lazy_factory = factory
+        self._lazy_value = None
+        self._lazy_lock = threading.Lock()
+
+    @property
+    def created(self) -> bool:
+        return self._lazy_value is not None
+
+    def resolve(self) -> Any:
+        if self._lazy_value is None:
+            with self._lazy_lock:
+                if self._lazy_value is None:
+                    self._lazy_value = self._lazy_factory()
+        return self._lazy_value
+
+    def replace(self, value: Any):
+        """
+        Forward to `value` from now on. Callers still holding the previous target keep using it.
+        """
+        with self._lazy_lock:
+            self._lazy_value = value
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.resolve(), name)
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.resolve()[key]
+
+
+class Container:
+    """
+    Owns the lifecycle of the lazy clients: startup, readiness and shutdown.
+
+    At startup Mongo is pinged and its indexes are created, whatever the warmup setting: the
+    unique indexes are what keeps concurrent saves from creating duplicate user documents
+    and buckets. The optional warmup also loads the tokenizer, builds the chat model chains of
+    the pipeline profile (no LLM request is made, the connection is opened by the first call) and embeds a query,
+    which opens the retriever connection. Startup runs in the background and is retried until
+    it succeeds, so the process is live at once and becomes ready when its steps are done.
+    """
+    def __init__(self, warmup: Optional[bool] = None, retry_interval: float = 10.0, timeout: float = 30.0):
+        if warmup is None:
+            warmup = os.environ.get('WARMUP_ON_STARTUP', 'true').lower() not in ('0', 'false', 'no')
+        self.warmup_enabled = warmup
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        # without warmup, only Mongo is checked up front, the other dependencies by the requests that use them
+        self.ready = False
+        self.errors: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _warm_mongo(self):
+        from scripts import chat_persistence_service as persistence
+        await persistence.async_client.admin.command('ping')
+        await persistence.aensure_indexes()
+
+    async def _warm_tokenizer(self):
+        from scripts import tokens
+        # falls back to an estimate when the BPE ranks can't be fetched, so this step can't fail
+        await asyncio.to_thread(tokens.encoding)
+
+    async def _warm_agents(self):
+        from workflows import agents, graphs
+        # the chains of the active pipeline profile, see `graphs.build_workflow`
+        if graphs.PIPELINE_PROFILE == "fused":
+            chains = (agents.document_grader, agents.prompt_rewriter, agents.fused_assistant)
+        else:
+            chains = (agents.document_grader, agents.prompt_rewriter, agents.answer_generator, agents.assistant)
+        for chain in chains:
+            if isinstance(chain, Lazy):
+                chain.resolve()
+
+    async def _warm_retriever(self):
+        from workflows import graphs
+        await graphs.manager.asearch_matching(query="warmup")
+
+    async def warmup(self) -> bool:
+        """
+        Run every startup step concurrently. Returns whether all of them succeeded.
+        """
+        steps = {"mongo": self._warm_mongo}
+        if self.warmup_enabled:
+            steps.update(tokenizer=self._warm_tokenizer, agents=self._warm_agents, retriever=self._warm_retriever)
+        results = await asyncio.gather(
+            *(asyncio.wait_for(step(), timeout=self.timeout) for step in steps.values()),
+            return_exceptions=True
+        )
+        self.errors = {name: repr(result) for name, result in zip(steps, results) if isinstance(result, BaseException)}
+        for name, error in self.errors.items():
+            logger.warning("Warmup of %s failed: %s", name, error)
+        self.ready = not self.errors
+        return self.ready
+
+    async def _warm_until_ready(self):
+        while not await self.warmup():
+            await asyncio.sleep(self.retry_interval)
+        logger.info("Startup complete")
+
+    def start(self):
+        self._task = asyncio.create_task(self._warm_until_ready())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        from scripts import chat_persistence_service as persistence
+        from scripts import llm_gateway
+        await llm_gateway.aclose()
+        for client in (persistence.async_client, persistence.client):
+            if isinstance(client, Lazy) and client.created:
+                closed = client.close()
+                if asyncio.iscoroutine(closed):
+                    await closed
@@ -0,0 +1,133 @@
+"""
+Assemble the retrieved chunks into the context handed to the answer prompt.
+
+Near-identical chunks are dropped, the rest are ordered by maximal marginal relevance so
+each chunk adds information the ones before it don't have, and they are packed into a token
+budget, the last chunk cut at a sentence boundary.
+"""
+import re
+from typing import List, Optional
+import numpy as np
+from scripts.local_vector_store import HashingEmbedder
+from scripts.retrievers import ScoredDocument
+from scripts.tokens import count_tokens
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+SEPARATOR = "\n\n"
+MIN_FRAGMENT_TOKENS = 32  # a truncated chunk shorter than this isn't worth its place
+
+
+def _unit_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def _embeddings(documents: List[ScoredDocument]) -> np.ndarray:
+    """
+    The retrieval embeddings of the documents, or lexical hashing vectors when some are missing one (BM25-only matches).
+    """
+    if all(doc.get("embedding") for doc in documents) and len({len(doc["embedding"]) for doc in documents}) == 1:
+        return _unit_rows(np.asarray([doc["embedding"] for doc in documents], dtype=np.float32))
+    return _unit_rows(np.asarray(HashingEmbedder()([doc["text"] for doc in documents]), dtype=np.float32))
+
+def _relevance(documents: List[ScoredDocument]) -> np.ndarray:
+    """
+    The retrieval scores scaled to [0, 1], falling back to the rank when some scores are missing.
+    """
+    for key in ("score", "rrf_score"):
+        values = [doc.get(key) for doc in documents]
+        if all(value is not None for value in values):
+            scores = np.asarray(values, dtype=np.float32)
+            spread = scores.max() - scores.min()
+            return (scores - scores.min()) / spread if spread > 0 else np.ones(len(documents), dtype=np.float32)
+    return np.linspace(1, 0, len(documents), dtype=np.float32) if len(documents) > 1 else np.ones(1, dtype=np.float32)
+
+def deduplicate(order: List[int], similarity: np.ndarray, threshold: float) -> List[int]:
+    """
+    Keep the documents of `order` that aren't at least `threshold` similar to an earlier kept one.
+    """
+    kept: List[int] = []
+    for i in order:
+        if all(similarity[i, j] < threshold for j in kept):
+            kept.append(i)
+    return kept
+
+def mmr(candidates: List[int], relevance: np.ndarray, similarity: np.ndarray, lambda_mult: float) -> List[int]:
+    """
+    Order `candidates` by maximal marginal relevance: `lambda_mult` weighs relevance against novelty.
+    """
+    remaining = list(candidates)
+    selected: List[int] = []
+    while remaining:
+        def marginal(i):
+            redundancy = max((similarity[i, j] for j in selected), default=0.0)
+            return lambda_mult * relevance[i] - (1 - lambda_mult) * redundancy
+        best = max(remaining, key=marginal)
+        selected.append(best)
+        remaining.remove(best)
+    return selected
+
+def truncate_sentences(text: str, budget: int) -> Optional[str]:
+    """
+    The longest run of leading sentences of `text` within `budget` tokens, None if not even the first fits.
+    """
+    kept = []
+    used = 0
+    for sentence in SENTENCE_BOUNDARY.split(text):
+        if not sentence.strip():
+            continue
+        tokens = count_tokens(sentence + " ")
+        if used + tokens > budget:
+            break
+        kept.append(sentence)
+        used += tokens
+    return " ".join(kept) if kept else None
+
+def pack(texts: List[str], budget: int) -> List[str]:
+    """
+    Fit `texts`, in order, into `budget` tokens. A text that doesn't fit is cut at a sentence
+    boundary when enough budget is left for a meaningful fragment, and packing stops there.
+    """
+    packed = []
+    remaining = budget
+    separator_tokens = count_tokens(SEPARATOR)
+    for text in texts:
+        cost = count_tokens(text) + (separator_tokens if packed else 0)
+        if cost <= remaining:
+            packed.append(text)
+            remaining -= cost
+            continue
+        room = remaining - (separator_tokens if packed else 0)
+        if room >= MIN_FRAGMENT_TOKENS:
+            fragment = truncate_sentences(text, room)
+            if fragment:
+                packed.append(fragment)
+        break
+    return packed
+
+def assemble_context(documents: List[ScoredDocument], token_budget: int = 1500, lambda_mult: float = 0.7, dedupe_threshold: float = 0.95) -> List[str]:
+    """
+    The chunk texts to answer from: de-duplicated, ordered by MMR and packed into `token_budget` tokens.
+
+    Args:
+        documents: the graded documents, most relevant first
+        token_budget: tokens of context handed to the answer prompt
+        lambda_mult: 1 orders by relevance alone, lower values favour chunks unlike the ones already picked
+        dedupe_threshold: cosine similarity above which a chunk is a duplicate of a more relevant one
+    """
+    if not documents:
+        return []
+    # exact duplicates first, the hybrid retriever can return the same text under two ids
+    unique, seen = [], set()
+    for doc in documents:
+        if doc["text"] not in seen:
+            seen.add(doc["text"])
+            unique.append(doc)
+
+    vectors = _embeddings(unique)
+    similarity = vectors @ vectors.T
+    relevance = _relevance(unique)
+    by_relevance = sorted(range(len(unique)), key=lambda i: -relevance[i])
+    candidates = deduplicate(by_relevance, similarity, dedupe_threshold)
+    order = mmr(candidates, relevance, similarity, lambda_mult)
+    return pack([unique[i]["text"] for i in order], token_budget)
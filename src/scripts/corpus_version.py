@@ -0,0 +1,54 @@
+"""
+The version of the indexed corpus, shared by the ingestion and the API processes through Mongo.
+
+`scripts.ingest` bumps it at the end of every run that changed the index. The API reads it,
+at most every CORPUS_VERSION_TTL seconds, to key the answers it caches, so a re-ingestion
+invalidates them in every replica without a restart. A new version also makes the API reload
+the on-disk indexes first, see `workflows.graphs.refresh_manager`.
+"""
+import os
+import logging
+from datetime import datetime
+from pymongo import ReturnDocument
+from scripts.cache import TTLCache
+from scripts import chat_persistence_service as persistence
+from scripts.metrics import MONGO_LATENCY, span
+
+logger = logging.getLogger(__name__)
+
+CORPUS_DOCUMENT = {'name': 'corpus'}
+_VERSION_CACHE = TTLCache(maxsize=1, ttl=float(os.environ.get('CORPUS_VERSION_TTL', 5)))
+_last_known = 0
+
+
+def bump_corpus_version() -> int:
+    """
+    Record that the corpus changed. Returns the new version.
+    """
+    with span(MONGO_LATENCY, "bump_corpus_version"):
+        doc = persistence.meta_collection.find_one_and_update(
+            CORPUS_DOCUMENT,
+            {'$inc': {'version': 1}, '$set': {'updated_at': datetime.utcnow().isoformat()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    return doc['version']
+
+async def acorpus_version() -> int:
+    """
+    The shared corpus version, 0 before the first recorded ingestion.
+    When Mongo can't be reached the last version read is returned.
+    """
+    global _last_known
+    version = _VERSION_CACHE.get('version')
+    if version is not None:
+        return version
+    try:
+        with span(MONGO_LATENCY, "load_corpus_version"):
+            doc = await persistence.async_meta_collection.find_one(CORPUS_DOCUMENT, {'version': 1, '_id': 0})
+    except Exception as e:
+        logger.warning("Could not read the corpus version: %s", e)
+        return _last_known
+    _last_known = doc['version'] if doc else 0
+    _VERSION_CACHE.set('version', _last_known)
+    return _last_known
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+import numpy as np
+
+KEY_SIZE = 16  # bytes of the sha256 digest kept per key
+
+
+def content_id(text: str) -> str:
+    """
+    A stable vector id derived from the chunk text, so unchanged chunks keep their id across runs.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def embedding_key(text: str, model_name: str) -> bytes:
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).digest()[:KEY_SIZE]
+
+
+class EmbeddingCache:
+    """
+    A persistent, content-addressed cache of passage embeddings.
+
+    Vectors are appended to a raw float32 file that is read through a memory map, and the
+    key of row `i` is the `i`-th 16 byte record of a compact key file. Keys are written after
+    their vectors, so an interrupted append leaves at most some orphan rows behind. All rows
+    have the dimension of the first vector stored, models of another dimension need their own cache.
+
+    The cache also remembers which vector ids were upserted to which index/namespace, so
+    re-ingesting unchanged chunks can skip the upsert as well as the embedding.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._vectors_file = os.path.join(path, "embeddings.f32")
+        self._keys_file = os.path.join(path, "keys.bin")
+        self._meta_file = os.path.join(path, "meta.json")
+        self._lock = threading.Lock()
+        self._stored: Dict[str, Set[str]] = {}
+        self._map: Optional[np.memmap] = None
+
+        self.dim: Optional[int] = None
+        if os.path.exists(self._meta_file):
+            with open(self._meta_file, encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+
+        keys = b""
+        if os.path.exists(self._keys_file):
+            with open(self._keys_file, "rb") as f:
+                keys = f.read()
+        count = len(keys) // KEY_SIZE
+        if self.dim and os.path.exists(self._vectors_file):
+            count = min(count, os.path.getsize(self._vectors_file) // (4 * self.dim))
+            # drop rows left behind by an interrupted append so row numbers stay aligned with the keys
+            with open(self._vectors_file, "r+b") as f:
+                f.truncate(count * 4 * self.dim)
+            if os.path.exists(self._keys_file):
+                with open(self._keys_file, "r+b") as f:
+                    f.truncate(count * KEY_SIZE)
+        self._rows: Dict[bytes, int] = {keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(count)}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _vector(self, row: int) -> List[float]:
+        if self._map is None or row >= self._map.shape[0]:
+            rows = os.path.getsize(self._vectors_file) // (4 * self.dim)
+            self._map = np.memmap(self._vectors_file, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return self._map[row].tolist()
+
+    def get_many(self, texts: List[str], model_name: str) -> List[Optional[List[float]]]:
+        with self._lock:
+            rows = [self._rows.get(embedding_key(text, model_name)) for text in texts]
+            return [self._vector(row) if row is not None else None for row in rows]
+
+    def put_many(self, texts: List[str], model_name: str, vectors: List[List[float]]):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                with open(self._meta_file, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            elif matrix.shape[1] != self.dim:
+                # rows are read back as `dim` floats, a vector of another size would shift every later row
+                raise ValueError(
+                    f"the embedding cache at {self.path} holds {self.dim}-dimensional vectors, "
+                    f"{model_name} returned {matrix.shape[1]}; use another cache directory for this model"
+                )
+            keys = [embedding_key(text, model_name) for text in texts]
+            fresh, seen = [], set()
+            for i, key in enumerate(keys):
+                if key not in self._rows and key not in seen:
+                    fresh.append(i)
+                    seen.add(key)
+            if not fresh:
+                return
+            with open(self._vectors_file, "ab") as f:
+                f.write(matrix[fresh].tobytes())
+            with open(self._keys_file, "ab") as f:
+                f.write(b"".join(keys[i] for i in fresh))
+            for i in fresh:
+                self._rows[keys[i]] = len(self._rows)
+
+    def _stored_file(self, target: str) -> str:
+        return os.path.join(self.path, "stored-" + hashlib.sha256(target.encode("utf-8")).hexdigest()[:16] + ".ids")
+
+    def _stored_ids(self, target: str) -> Set[str]:
+        if target not in self._stored:
+            file = self._stored_file(target)
+            ids = set()
+            if os.path.exists(file):
+                with open(file, encoding="utf-8") as f:
+                    ids = {line.strip() for line in f if line.strip()}
+            self._stored[target] = ids
+        return self._stored[target]
+
+    def unstored(self, target: str, ids: Iterable[str]) -> List[str]:
+        """
+        The ids that have not been upserted to `target` yet.
+        """
+        with self._lock:
+            stored = self._stored_ids(target)
+            return [id_ for id_ in ids if id_ not in stored]
+
+    def mark_stored(self, target: str, ids: Iterable[str]):
+        with self._lock:
+            stored = self._stored_ids(target)
+            fresh = [id_ for id_ in ids if id_ not in stored]
+            if not fresh:
+                return
+            with open(self._stored_file(target), "a", encoding="utf-8") as f:
+                f.write("".join(f"{id_}\n" for id_ in fresh))
+            stored.update(fresh)
+
+    def stored(self, target: str) -> Set[str]:
+        """
+        The ids upserted to `target`.
+        """
+        with self._lock:
+            return set(self._stored_ids(target))
+
+    def unmark_stored(self, target: str, ids: Iterable[str]):
+        """
+        Remove ids deleted from `target` from its upsert manifest.
+        """
+        with self._lock:
+            stored = self._stored_ids(target)
+            stored.difference_update(ids)
+            file = self._stored_file(target)
+            with open(file + ".tmp", "w", encoding="utf-8") as f:
+                f.write("".join(f"{id_}\n" for id_ in sorted(stored)))
+            os.replace(file + ".tmp", file)
+
+    def forget_stored(self, target: str):
+        """
+        Drop the upsert manifest of `target`, e.g. after the index was recreated.
+        """
+        with self._lock:
+            self._stored.pop(target, None)
+            if os.path.exists(self._stored_file(target)):
+                os.remove(self._stored_file(target))
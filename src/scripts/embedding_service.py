@@ -1,65 +1,189 @@
-from typing import List
+import asyncio
+from typing import List, Optional, Set
 from langchain_core.documents import Document
 from langchain_text_splitters import MarkdownHeaderTextSplitter
 from pinecone.grpc import PineconeGRPC as Pinecone
 from pinecone.core.openapi.inference.models import EmbeddingsList
 import os
 from dotenv import load_dotenv, find_dotenv
+from scripts.cache import TTLCache, normalize_query
+from scripts.retrievers import ScoredDocument
+from scripts.embedding_cache import EmbeddingCache, content_id
+from scripts.metrics import RETRIEVER_LATENCY, span
 
 class PineconeEmbeddingManager:
-    def __init__(self, api_key: str, index_name: str, name_space: str):
+    """
+    The Pinecone implementation of the `Retriever` protocol.
+    """
+    def __init__(self, api_key: str, index_name: str, name_space: str, cache_size: int = 1024, cache_ttl: float = 3600, embedding_cache: Optional[EmbeddingCache] = None):
         self.pc = Pinecone(api_key=api_key)
         self.index_name = index_name
         self.name_space = name_space
+        self._index = None
+        # optional on-disk cache of passage embeddings, consulted when (re-)ingesting
+        self.embedding_cache = embedding_cache
+        # query embeddings keyed by (normalized query, model name)
+        self.query_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    @property
+    def index(self):
+        # the index handle holds the connection, create it once and reuse it
+        if self._index is None:
+            self._index = self.pc.Index(name=self.index_name)
+        return self._index
     
-    def create_embeddings(self, documents: List[Document], model_name: str = "llama-text-embed-v2") -> EmbeddingsList:
-        return self.pc.inference.embed(
-            model=model_name,
-            inputs=[d.page_content for d in documents],
-            parameters={"input_type": "passage", "truncate": "END"}
-        )
+    def _embed_passages(self, texts: List[str], model_name: str, batch_size: int = 96) -> List[List[float]]:
+        """
+        Embed passages, only sending the texts missing from the embedding cache to the model.
+        """
+        vectors = self.embedding_cache.get_many(texts, model_name) if self.embedding_cache is not None else [None] * len(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        # the inference api caps the number of inputs per request, embed in batches
+        for start in range(0, len(missing), batch_size):
+            positions = missing[start:start + batch_size]
+            with span(RETRIEVER_LATENCY, "pinecone_embed_passages"):
+                embeddings = self.pc.inference.embed(
+                    model=model_name,
+                    inputs=[texts[i] for i in positions],
+                    parameters={"input_type": "passage", "truncate": "END"}
+                )
+            embedded = [list(e['values']) for e in embeddings]
+            for i, values in zip(positions, embedded):
+                vectors[i] = values
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many([texts[i] for i in positions], model_name, embedded)
+        return vectors
+
+    def create_embeddings(self, documents: List[Document], model_name: str = "llama-text-embed-v2", batch_size: int = 96) -> List[dict]:
+        vectors = self._embed_passages([d.page_content for d in documents], model_name, batch_size=batch_size)
+        return [{"values": values} for values in vectors]
     
-    def store_embeddings(self, embeddings: EmbeddingsList, documents: List[Document]):
-        index = self.pc.Index(name=self.index_name)
-        records = [
-            {"id": f"vector{idx}", "values": e['values'], "metadata": {"text": d.page_content}}
-            for idx, (d, e) in enumerate(zip(documents, embeddings))
-        ]
-        return index.upsert(vectors=records, namespace=self.name_space)
+    def upsert_target(self) -> str:
+        return f"{self.index_name}/{self.name_space}"
+
+    def store_embeddings(self, embeddings: EmbeddingsList, documents: List[Document], ids: Optional[List[str]] = None):
+        # content hash ids keep unchanged chunks on the same vector across runs
+        ids = ids or [content_id(d.page_content) for d in documents]
+        return self.upsert(ids, [e['values'] for e in embeddings], [d.page_content for d in documents])
     
-    def create_and_store_embeddings(self, documents: List[Document]):
+    def create_and_store_embeddings(self, documents: List[Document], ids: Optional[List[str]] = None):
         embeddings = self.create_embeddings(documents)
-        result = self.store_embeddings(embeddings, documents)
+        result = self.store_embeddings(embeddings, documents, ids=ids)
         print(result)
     
-    def search_matching(self, query: str, model: str = "llama-text-embed-v2", top_k: int = 3):
-        index = self.pc.Index(name=self.index_name)
-        query_embedding = self.pc.inference.embed(
-            model=model,
-            inputs=[query],
-            parameters={"input_type": "query"}
-        )
-
-
-        results =  index.query(
-            namespace=self.name_space,
-            vector=query_embedding[0].values,
-            top_k=top_k,
-            include_values=False,
-            include_metadata=True
-        )['matches']
-
-        documents = [result['metadata']['text'] for result in results]
-
-        return documents
+    def embed_query(self, query: str, model: str = "llama-text-embed-v2") -> List[float]:
+        key = (normalize_query(query), model)
+        values = self.query_cache.get(key)
+        if values is None:
+            with span(RETRIEVER_LATENCY, "pinecone_embed_query"):
+                query_embedding = self.pc.inference.embed(
+                    model=model,
+                    inputs=[query],
+                    parameters={"input_type": "query"}
+                )
+            values = list(query_embedding[0].values)
+            self.query_cache.set(key, values)
+        return values
+
+    def embed_queries(self, queries: List[str], model: str = "llama-text-embed-v2", batch_size: int = 96) -> List[List[float]]:
+        """
+        Embed many queries, sending the ones missing from the query cache in batched requests.
+        """
+        keys = [(normalize_query(query), model) for query in queries]
+        vectors = [self.query_cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        for start in range(0, len(missing), batch_size):
+            positions = missing[start:start + batch_size]
+            with span(RETRIEVER_LATENCY, "pinecone_embed_queries"):
+                embeddings = self.pc.inference.embed(
+                    model=model,
+                    inputs=[queries[i] for i in positions],
+                    parameters={"input_type": "query"}
+                )
+            for i, embedding in zip(positions, embeddings):
+                vectors[i] = list(embedding['values'])
+                self.query_cache.set(keys[i], vectors[i])
+        return vectors
+
+    def cache_stats(self):
+        return self.query_cache.stats()
+
+    def embed(self, texts: List[str], input_type: str = "passage", model: str = "llama-text-embed-v2") -> List[List[float]]:
+        if input_type == "query":
+            return self.embed_queries(texts, model=model)
+        return self._embed_passages(texts, model)
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str]) -> int:
+        records = [
+            {"id": id_, "values": values, "metadata": {"text": text}}
+            for id_, values, text in zip(ids, vectors, texts)
+        ]
+        if self.embedding_cache is not None:
+            # ids are content hashes, a stored id already holds exactly this text
+            unstored = set(self.embedding_cache.unstored(self.upsert_target(), ids))
+            records = [record for record in records if record["id"] in unstored]
+        if records:
+            with span(RETRIEVER_LATENCY, "pinecone_upsert"):
+                self.index.upsert(vectors=records, namespace=self.name_space)
+            if self.embedding_cache is not None:
+                self.embedding_cache.mark_stored(self.upsert_target(), [record["id"] for record in records])
+        return len(records)
+
+    def _stored_ids(self) -> Set[str]:
+        if self.embedding_cache is not None:
+            return self.embedding_cache.stored(self.upsert_target())
+        # listing ids is only supported by serverless indexes
+        return {id_ for page in self.index.list(namespace=self.name_space) for id_ in page}
+
+    def prune(self, keep: Set[str], batch_size: int = 1000) -> int:
+        """
+        Delete the vectors of the namespace whose id is not in `keep`, e.g. chunks that were edited or removed.
+        The stored ids are read from the upsert manifest when there is one, listed from the index otherwise.
+        Returns:
+            int: the number of deleted vectors
+        """
+        stale = sorted(self._stored_ids() - set(keep))
+        # the delete endpoint caps the number of ids per request
+        for start in range(0, len(stale), batch_size):
+            with span(RETRIEVER_LATENCY, "pinecone_delete"):
+                self.index.delete(ids=stale[start:start + batch_size], namespace=self.name_space)
+        if stale and self.embedding_cache is not None:
+            self.embedding_cache.unmark_stored(self.upsert_target(), stale)
+        return len(stale)
+
+    def query(self, vector: List[float], top_k: int = 3) -> List[ScoredDocument]:
+        with span(RETRIEVER_LATENCY, "pinecone_query"):
+            results = self.index.query(
+                namespace=self.name_space,
+                vector=vector,
+                top_k=top_k,
+                include_values=True,
+                include_metadata=True
+            )['matches']
+
+        # the vectors are kept for the context assembly (de-duplication and MMR)
+        return [
+            {"id": result['id'], "text": result['metadata']['text'], "score": result['score'], "embedding": list(result['values'])}
+            for result in results
+        ]
+
+    def search_matching(self, query: str, model: str = "llama-text-embed-v2", top_k: int = 3) -> List[ScoredDocument]:
+        return self.query(self.embed_query(query, model=model), top_k=top_k)
+
+    async def asearch_matching(self, query: str, model: str = "llama-text-embed-v2", top_k: int = 3) -> List[ScoredDocument]:
+        # the gRPC client is blocking, run it in a worker thread so the event loop stays free
+        return await asyncio.to_thread(self.search_matching, query=query, model=model, top_k=top_k)
         
 if __name__ == '__main__':
+    # a quick round trip against the configured index, use `python -m scripts.ingest` to index a corpus
     load_dotenv(find_dotenv())
     api_key = os.environ.get('PINECONE_API_KEY')
-    pinecone_index = os.environ.get('INDEX_NAME')
-    pinecone_namespace = os.environ.get('NAMESPACE')
+    pinecone_index = os.environ.get('INDEX_NAME') or 'kifiya'
+    pinecone_namespace = os.environ.get('NAMESPACE') or 'test'
 
-    manager = PineconeEmbeddingManager(api_key=api_key, index_name='kifiya', name_space='test')
+    manager = PineconeEmbeddingManager(api_key=api_key, index_name=pinecone_index, name_space=pinecone_namespace)
     
     markdown_document = '''
     ### This is a test section
@@ -73,8 +197,8 @@ if __name__ == '__main__':
     markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on)
     md_header_splits = markdown_splitter.split_text(markdown_document)
     
-    manager.create_and_store_embeddings(md_header_splits, index_name=pinecone_index, name_space=pinecone_namespace)
+    manager.create_and_store_embeddings(md_header_splits, ids=[f"test-section-{idx}" for idx in range(len(md_header_splits))])
     
     result = manager.search_matching("Where can I contact kifiya?")
     for doc in result:
-        print(doc)
+        print(doc['score'], doc['text'])
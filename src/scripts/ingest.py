@@ -0,0 +1,179 @@
+"""
+Index a directory of markdown files into the configured retriever.
+
+Files are parsed and split on their markdown headers in a process pool, the chunks are
+streamed into fixed-size embedding batches and several embed+upsert batches are kept in
+flight at once. Chunks are identified by a hash of their text and embeddings are kept in
+an on-disk cache, so re-ingesting only embeds and upserts new or changed chunks. Vectors
+of chunks that are no longer in the corpus (edited or removed) are deleted at the end of
+the run. When a BM25 index path is configured, the lexical index is rebuilt over the same chunks,
+or updated in place by a partial run with `--keep-stale`.
+A run that changed the index bumps the corpus version shared with the API through Mongo.
+
+Usage (from `src/`):
+    python -m scripts.ingest ../docs --batch-size 96 --concurrency 4
+"""
+import os
+import time
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, List, Tuple
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+from scripts.retrievers import Retriever, create_retriever
+from scripts.embedding_cache import content_id
+from scripts.corpus_version import bump_corpus_version
+
+HEADERS_TO_SPLIT_ON = [("#", "Header 1"), ("##", "Header 2"), ("###", "Header 3"), ("####", "Header 4")]
+
+# (vector id, chunk text)
+Chunk = Tuple[str, str]
+
+
+def find_markdown_files(root: str) -> List[str]:
+    files = []
+    for directory, _, names in os.walk(root):
+        files.extend(os.path.join(directory, name) for name in names if name.lower().endswith((".md", ".markdown")))
+    return sorted(files)
+
+
+def split_markdown_file(path: str) -> List[Chunk]:
+    """
+    Parse a markdown file and split it on its headers. Runs in a worker process.
+    Returns:
+        list: (id, text) pairs, ids are content hashes of the chunk text
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    splitter = MarkdownHeaderTextSplitter(HEADERS_TO_SPLIT_ON, strip_headers=False)
+    return [
+        (content_id(chunk.page_content), chunk.page_content)
+        for chunk in splitter.split_text(text)
+        if chunk.page_content.strip()
+    ]
+
+
+def batched(chunks: Iterable[Chunk], batch_size: int) -> Iterator[List[Chunk]]:
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def embed_and_upsert(retriever: Retriever, batch: List[Chunk]) -> Tuple[int, int]:
+    """
+    Returns:
+        tuple: the number of processed chunks and the number actually upserted
+    """
+    ids = [id_ for id_, _ in batch]
+    texts = [text for _, text in batch]
+    return len(batch), retriever.upsert(ids, retriever.embed(texts, input_type="passage"), texts)
+
+
+def ingest(retriever: Retriever, root: str, batch_size: int = 96, concurrency: int = 4, workers: int = None, prune: bool = True) -> int:
+    """
+    Ingest every markdown file under `root` into `retriever`.
+    Args:
+        retriever: the store receiving the vectors
+        root: directory searched recursively for markdown files
+        batch_size: number of chunks per embedding/upsert call
+        concurrency: number of embedding/upsert batches in flight
+        workers: size of the parsing process pool (defaults to the cpu count)
+        prune: delete the stored vectors of chunks not found under `root`
+    Returns:
+        int: the number of processed chunks
+    """
+    files = find_markdown_files(root)
+    print(f"Found {len(files)} markdown files under {root}")
+    started = time.perf_counter()
+    processed = 0
+    upserted = 0
+    parsed_files = 0
+    seen = set()
+
+    def parsed_chunks(parsed: Iterable[List[Chunk]]) -> Iterator[Chunk]:
+        nonlocal parsed_files
+        for chunks in parsed:
+            parsed_files += 1
+            seen.update(id_ for id_, _ in chunks)
+            yield from chunks
+
+    def report(done):
+        nonlocal processed, upserted
+        for future in done:
+            batch_processed, batch_upserted = future.result()
+            processed += batch_processed
+            upserted += batch_upserted
+        elapsed = time.perf_counter() - started
+        print(f"files {parsed_files}/{len(files)} | chunks {processed} | upserted {upserted} | {processed / elapsed:.1f} chunks/s", flush=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as parsers, ThreadPoolExecutor(max_workers=concurrency) as uploaders:
+        parsed = parsers.map(split_markdown_file, files, chunksize=8)
+        in_flight = set()
+        for batch in batched(parsed_chunks(parsed), batch_size):
+            # bound the number of batches held in memory to the upload concurrency
+            if len(in_flight) >= concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                report(done)
+            in_flight.add(uploaders.submit(embed_and_upsert, retriever, batch))
+        done, _ = wait(in_flight)
+        report(done)
+
+    removed = 0
+    remove_stale = getattr(retriever, "prune", None)
+    if prune and callable(remove_stale):
+        # only reached when every batch was upserted, a failed run keeps the previous vectors
+        removed = remove_stale(seen)
+        print(f"Deleted {removed} stale chunks")
+
+    save = getattr(retriever, "save", None)
+    if callable(save):
+        save()
+
+    if upserted or removed:
+        # the API drops the answers it cached for the previous corpus
+        try:
+            print(f"Corpus version is now {bump_corpus_version()}")
+        except Exception as e:
+            print(f"Could not bump the corpus version, cached answers stay valid until CORPUS_VERSION is changed: {e}")
+
+    elapsed = time.perf_counter() - started
+    print(f"Ingested {processed} chunks ({upserted} upserted) from {len(files)} files in {elapsed:.1f}s ({processed / max(elapsed, 1e-9):.1f} chunks/s)")
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index a directory of markdown files into the retriever")
+    parser.add_argument("root", help="directory containing the markdown corpus")
+    parser.add_argument("--backend", choices=["pinecone", "local"], help="overrides RETRIEVER_BACKEND")
+    parser.add_argument("--local-index-path", help="overrides LOCAL_INDEX_PATH")
+    parser.add_argument("--batch-size", type=int, default=96, help="chunks per embedding/upsert batch")
+    parser.add_argument("--concurrency", type=int, default=4, help="embedding/upsert batches in flight")
+    parser.add_argument("--workers", type=int, default=None, help="parsing processes (defaults to the cpu count)")
+    parser.add_argument("--cache-dir", default=os.environ.get("EMBEDDING_CACHE_DIR", "data/embedding-cache"), help="on-disk embedding cache")
+    parser.add_argument("--no-cache", action="store_true", help="embed and upsert every chunk")
+    parser.add_argument("--reupload", action="store_true", help="forget which chunks were upserted, e.g. after recreating the index")
+    parser.add_argument("--keep-stale", action="store_true", help="keep the vectors of chunks no longer under root, e.g. when ingesting part of the corpus")
+    parser.add_argument("--bm25-path", default=os.environ.get("BM25_INDEX_PATH"), help="BM25 index rebuilt over the ingested chunks")
+    args = parser.parse_args()
+
+    retriever = create_retriever(
+        backend=args.backend,
+        local_index_path=args.local_index_path,
+        embedding_cache_dir=None if args.no_cache else args.cache_dir,
+        bm25_index_path=args.bm25_path,
+        # a partial run keeps the lexical entries of the files it didn't read
+        rebuild_bm25=not args.keep_stale
+    )
+    dense = getattr(retriever, "dense", retriever)
+    cache = getattr(dense, "embedding_cache", None)
+    if cache is not None and args.reupload:
+        cache.forget_stored(dense.upsert_target())
+    ingest(retriever, args.root, batch_size=args.batch_size, concurrency=args.concurrency, workers=args.workers, prune=not args.keep_stale)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,472 @@
+"""
+The shared gateway every OpenAI-compatible LLM call of the API goes through.
+
+The chat model of the graph and the OpenAI clients of the chat persistence service all send
+their requests through one pooled `httpx` transport, wrapped by the gateway which:
+
+- caps the requests in flight per model with an `AdaptiveLimiter`, an AIMD limit that grows
+  while calls succeed at a steady latency and halves on 429s, 5xx, errors or a latency spike
+- optionally hedges async requests: when a call has not answered after the model's p95
+  latency, a duplicate is sent to the next of `LLM_BASE_URIS` and the first reply wins
+
+Retries and their backoff are left to the OpenAI SDK (`LLM_MAX_RETRIES`), which honours the
+`Retry-After` of a 429 while the gateway lowers the limit.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+import httpx
+from dotenv import load_dotenv, find_dotenv
+from scripts.metrics import LLM_CONCURRENCY_LIMIT, LLM_HEDGES, LLM_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter:
+    """
+    A concurrency limit adjusted by additive increase / multiplicative decrease.
+
+    Every successful call raises the limit by `1 / limit` (about one per window of calls)
+    unless the smoothed latency exceeds `tolerance` times the slowly tracked baseline, in which
+    case it is multiplied by `backoff` like an overloaded call. Latencies are tracked per call
+    kind (streamed or not), whose normal latencies differ. Decreases are spaced by at least
+    `cooldown` seconds so one burst of errors halves the limit once. Usable from threads and
+    event loops alike.
+    """
+    def __init__(self, name: str = "default", initial: int = 16, minimum: int = 1, maximum: int = 64, backoff: float = 0.5, tolerance: float = 2.0, cooldown: float = 1.0):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        # call kind -> latency
+        self.smoothed_latency: Dict[str, float] = {}
+        self.baseline_latency: Dict[str, float] = {}
+        self._last_decrease = float("-inf")
+        self._waiters: Deque[concurrent.futures.Future] = deque()
+        self._lock = threading.Lock()
+        LLM_CONCURRENCY_LIMIT.labels(name).set(self.limit)
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < max(int(self.limit), self.minimum)
+
+    def _wake(self):
+        while self._waiters and self._has_capacity():
+            waiter = self._waiters.popleft()
+            # skips the waiters that gave up
+            if waiter.set_running_or_notify_cancel():
+                self.in_flight += 1
+                waiter.set_result(True)
+
+    def _enqueue(self) -> Optional[concurrent.futures.Future]:
+        with self._lock:
+            if not self._waiters and self._has_capacity():
+                self.in_flight += 1
+                return None
+            waiter = concurrent.futures.Future()
+            self._waiters.append(waiter)
+            return waiter
+
+    def _abandon(self, waiter: concurrent.futures.Future):
+        with self._lock:
+            # the slot may have been granted just as the caller gave up
+            if not waiter.cancel():
+                self.in_flight -= 1
+                self._wake()
+
+    def acquire(self, timeout: Optional[float] = None):
+        waiter = self._enqueue()
+        if waiter is None:
+            return
+        try:
+            waiter.result(timeout=timeout)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def aacquire(self):
+        waiter = self._enqueue()
+        if waiter is None:
+            return
+        try:
+            await asyncio.wrap_future(waiter)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def try_acquire(self) -> bool:
+        """
+        Take a slot only if one is free right away.
+        """
+        with self._lock:
+            if self._waiters or not self._has_capacity():
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False, kind: str = "complete"):
+        """
+        Give the slot back, adapting the limit to the outcome of the call (a `latency` of None leaves it unchanged).
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if overloaded:
+                self._decrease()
+            elif latency is not None:
+                self._observe(latency, kind)
+            self._wake()
+
+    def _observe(self, latency: float, kind: str):
+        smoothed = self.smoothed_latency.get(kind)
+        baseline = self.baseline_latency.get(kind)
+        smoothed = self.smoothed_latency[kind] = latency if smoothed is None else smoothed + 0.2 * (latency - smoothed)
+        baseline = self.baseline_latency[kind] = latency if baseline is None else baseline + 0.01 * (latency - baseline)
+        if smoothed > self.tolerance * baseline:
+            self._decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            LLM_CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        LLM_CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+        logger.info("Lowered the concurrency limit of %s to %.1f", self.name, self.limit)
+
+
+def _call_of(request: httpx.Request) -> Tuple[str, str]:
+    """
+    The model and the kind of the call, `stream` or `complete`.
+    """
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, httpx.RequestNotRead):
+        return "default", "complete"
+    if not isinstance(body, dict):
+        return "default", "complete"
+    return body.get("model") or "default", "stream" if body.get("stream") else "complete"
+
+
+def _overloaded(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """
+    The body of a response, handing the limiter slot back once it is read and closed.
+    """
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._on_close()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close()
+
+
+class LLMGateway:
+    """
+    Per-model limiters, latency statistics and hedging policy shared by the gateway transports.
+
+    Args:
+        base_urls: the OpenAI-compatible endpoints, the first one is used by the clients and the others receive the hedges
+        hedge: whether async requests are hedged
+        hedge_min_delay: the shortest wait before hedging, in seconds
+        hedge_min_samples: successful calls of a model needed before its p95 is trusted
+        limiter_options: keyword arguments of every `AdaptiveLimiter`
+    """
+    def __init__(self, base_urls: List[str], hedge: bool = False, hedge_min_delay: float = 1.0, hedge_min_samples: int = 20, **limiter_options):
+        self.base_urls = [url.rstrip("/") for url in base_urls if url]
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.limiter_options = limiter_options
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+        self._latencies: Dict[Tuple[str, str], Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "LLMGateway":
+        base_urls = os.environ.get('LLM_BASE_URIS') or os.environ.get('BASE_URI') or ""
+        return cls(
+            base_urls=[url.strip() for url in base_urls.split(",")],
+            hedge=os.environ.get('LLM_HEDGE', 'false').lower() in ('1', 'true', 'yes'),
+            hedge_min_delay=float(os.environ.get('LLM_HEDGE_MIN_DELAY', 1.0)),
+            initial=int(os.environ.get('LLM_CONCURRENCY_INITIAL', 16)),
+            minimum=int(os.environ.get('LLM_CONCURRENCY_MIN', 1)),
+            maximum=int(os.environ.get('LLM_CONCURRENCY_MAX', 64))
+        )
+
+    @property
+    def base_url(self) -> Optional[str]:
+        return self.base_urls[0] if self.base_urls else None
+
+    def limiter(self, model: str) -> AdaptiveLimiter:
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = AdaptiveLimiter(name=model, **self.limiter_options)
+            return self._limiters[model]
+
+    def record(self, model: str, kind: str, latency: float):
+        with self._lock:
+            self._latencies.setdefault((model, kind), deque(maxlen=256)).append(latency)
+
+    def hedge_delay(self, model: str, kind: str) -> Optional[float]:
+        """
+        How long to wait for a reply before hedging, the p95 of the recent latencies of the model and call kind.
+        """
+        if not self.hedge:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies.get((model, kind), ()))
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, latencies[int(0.95 * (len(latencies) - 1))])
+
+    def retarget(self, request: httpx.Request) -> Optional[httpx.Request]:
+        """
+        A copy of `request` for the base URL following the one it was sent to.
+        """
+        url = str(request.url)
+        for i, base_url in enumerate(self.base_urls):
+            if url.startswith(base_url):
+                target = self.base_urls[(i + 1) % len(self.base_urls)] + url[len(base_url):]
+                headers = [(name, value) for name, value in request.headers.raw if name.lower() != b"host"]
+                return httpx.Request(request.method, target, headers=headers, content=request.content, extensions=request.extensions)
+        return None
+
+    def _outcome(self, request: httpx.Request, model: str, kind: str, limiter: AdaptiveLimiter, response: httpx.Response, started: float, stream_type):
+        """
+        Account the reply and wrap its body so the slot is released when the body is closed.
+
+        The latency is taken when the headers arrive: a streamed body stays open while the
+        answer is generated, its close time says nothing about how loaded the upstream is.
+        """
+        status_code = response.status_code
+        latency = time.perf_counter() - started
+        if status_code == 429:
+            LLM_THROTTLED.labels(model).inc()
+        elif status_code < 400:
+            self.record(model, kind, latency)
+        released = []
+
+        def on_close():
+            if not released:
+                released.append(True)
+                limiter.release(latency, overloaded=_overloaded(status_code), kind=kind)
+
+        return httpx.Response(
+            status_code,
+            headers=response.headers,
+            stream=stream_type(response.stream, on_close),
+            extensions=response.extensions,
+            request=request
+        )
+
+    def send(self, request: httpx.Request, transport: httpx.BaseTransport) -> httpx.Response:
+        model, kind = _call_of(request)
+        limiter = self.limiter(model)
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = transport.handle_request(request)
+        except BaseException:
+            limiter.release(overloaded=True)
+            raise
+        return self._outcome(request, model, kind, limiter, response, started, _ReleasingStream)
+
+    async def _aattempt(self, request: httpx.Request, transport: httpx.AsyncBaseTransport, model: str, kind: str, limiter: AdaptiveLimiter) -> httpx.Response:
+        # the caller has already taken the slot
+        started = time.perf_counter()
+        try:
+            response = await transport.handle_async_request(request)
+        except asyncio.CancelledError:
+            limiter.release()
+            raise
+        except BaseException:
+            limiter.release(overloaded=True)
+            raise
+        return self._outcome(request, model, kind, limiter, response, started, _AsyncReleasingStream)
+
+    async def asend(self, request: httpx.Request, transport: httpx.AsyncBaseTransport) -> httpx.Response:
+        model, kind = _call_of(request)
+        limiter = self.limiter(model)
+        await limiter.aacquire()
+        primary = asyncio.ensure_future(self._aattempt(request, transport, model, kind, limiter))
+        delay = self.hedge_delay(model, kind)
+        if delay is None:
+            return await primary
+
+        attempts = [primary]
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            hedge_request = None if done else self.retarget(request)
+            # hedges only use spare capacity, they must not add to an overload
+            if hedge_request is None or not limiter.try_acquire():
+                return await primary
+            attempts.append(asyncio.ensure_future(self._aattempt(hedge_request, transport, model, kind, limiter)))
+            LLM_HEDGES.labels("sent").inc()
+            return await self._first_reply(attempts)
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+
+    async def _first_reply(self, attempts: List[asyncio.Future]) -> httpx.Response:
+        """
+        The first successful reply among `attempts`, closing the replies that lost.
+        """
+        pending = set(attempts)
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if winner is None and attempt.exception() is None and not _overloaded(attempt.result().status_code):
+                    winner = attempt
+        if winner is None:
+            # every attempt failed, report the primary's failure
+            winner = attempts[0]
+        elif winner is not attempts[0]:
+            LLM_HEDGES.labels("won").inc()
+        for attempt in attempts:
+            if attempt is winner:
+                continue
+            if not attempt.done():
+                attempt.cancel()
+            elif attempt.exception() is None:
+                await attempt.result().aclose()
+        return winner.result()
+
+
+class GatewayTransport(httpx.BaseTransport):
+    def __init__(self, gateway: LLMGateway, transport: httpx.BaseTransport):
+        self.gateway = gateway
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return self.gateway.send(request, self.transport)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncGatewayTransport(httpx.AsyncBaseTransport):
+    def __init__(self, gateway: LLMGateway, transport: httpx.AsyncBaseTransport):
+        self.gateway = gateway
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.gateway.asend(request, self.transport)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+load_dotenv(find_dotenv())
+GATEWAY = LLMGateway.from_env()
+MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+
+_clients: Dict[str, object] = {}
+_clients_lock = threading.Lock()
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.environ.get('LLM_MAX_CONNECTIONS', 100)),
+        max_keepalive_connections=int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 20)),
+        keepalive_expiry=30
+    )
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(float(os.environ.get('LLM_TIMEOUT', 60)), connect=5.0)
+
+def _shared(name: str, factory):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+def http_client() -> httpx.Client:
+    """
+    The pooled sync HTTP client shared by every LLM client.
+    """
+    return _shared("sync", lambda: httpx.Client(
+        transport=GatewayTransport(GATEWAY, httpx.HTTPTransport(limits=_limits(), http2=False)),
+        timeout=_timeout()
+    ))
+
+def async_http_client() -> httpx.AsyncClient:
+    """
+    The pooled async HTTP client shared by every LLM client.
+    """
+    return _shared("async", lambda: httpx.AsyncClient(
+        transport=AsyncGatewayTransport(GATEWAY, httpx.AsyncHTTPTransport(limits=_limits(), http2=False)),
+        timeout=_timeout()
+    ))
+
+def chat_model(**kwargs):
+    """
+    A `ChatOpenAI` sending its requests through the gateway.
+    """
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        base_url=GATEWAY.base_url,
+        api_key=os.environ.get('API_KEY'),
+        http_client=http_client(),
+        http_async_client=async_http_client(),
+        max_retries=MAX_RETRIES,
+        **kwargs
+    )
+
+def openai_client():
+    from openai import OpenAI
+    return OpenAI(base_url=GATEWAY.base_url, api_key=os.environ.get('API_KEY'), http_client=http_client(), max_retries=MAX_RETRIES)
+
+def async_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(base_url=GATEWAY.base_url, api_key=os.environ.get('API_KEY'), http_client=async_http_client(), max_retries=MAX_RETRIES)
+
+async def aclose():
+    """
+    Close the shared HTTP clients, on shutdown.
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        if isinstance(client, httpx.AsyncClient):
+            await client.aclose()
+        else:
+            client.close()
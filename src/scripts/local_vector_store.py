@@ -0,0 +1,369 @@
+import os
+import json
+import asyncio
+import zlib
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Set
+import numpy as np
+from scripts.cache import TTLCache, normalize_query
+from scripts.retrievers import ScoredDocument
+from scripts.metrics import RETRIEVER_LATENCY, span
+
+Embedder = Callable[[List[str], str], List[List[float]]]
+
+# rows scored per block when the matrix is int8, bounds the float32 copy made for the dot product
+BLOCK_SIZE = 65536
+
+
+class HashingEmbedder:
+    """
+    Deterministic feature-hashing embedder.
+
+    It has no notion of semantics beyond shared tokens, but needs no model or network,
+    which makes it suitable for running the graph offline in tests and benchmarks.
+    """
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def __call__(self, texts: List[str], input_type: str = "passage") -> List[List[float]]:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in re.findall(r"\w+", text.lower()):
+                h = zlib.crc32(token.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return _normalize(vectors).tolist()
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _quantize(vectors: np.ndarray):
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def _atomic_save(file: str, array: np.ndarray):
+    with open(file + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(file + ".tmp", file)
+
+
+def _mtime(file: str) -> Optional[int]:
+    try:
+        return os.stat(file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+    if top_k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_k)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class IVFIndex:
+    """
+    An inverted-file approximate index: vectors are bucketed by their nearest k-means
+    centroid and a query only scores the rows of its `n_probe` closest buckets.
+    """
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, n_lists: Optional[int] = None, iterations: int = 10, seed: int = 0) -> "IVFIndex":
+        n = len(vectors)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(n, n_lists * 64), replace=False)].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+
+        assignment = np.concatenate([
+            np.argmax(vectors[start:start + BLOCK_SIZE].astype(np.float32) @ centroids.T, axis=1)
+            for start in range(0, n, BLOCK_SIZE)
+        ])
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        return cls(centroids.astype(np.float32), order, offsets)
+
+    def candidates(self, vector: np.ndarray, n_probe: int) -> np.ndarray:
+        lists = _top_k(self.centroids @ vector, min(n_probe, len(self.centroids)))
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+
+    def save(self, file: str):
+        with open(file + ".tmp", "wb") as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets)
+        os.replace(file + ".tmp", file)
+
+    @classmethod
+    def load(cls, file: str) -> Optional["IVFIndex"]:
+        if not os.path.exists(file):
+            return None
+        data = np.load(file)
+        return cls(data["centroids"], data["order"], data["offsets"])
+
+
+class LocalVectorStore:
+    """
+    An in-process vector store answering top-k queries with vectorized dot products.
+
+    Vectors are L2-normalized on upsert so the dot product is the cosine similarity. They
+    are kept as a float32 matrix, or as an int8 matrix with per-row scales when `quantize`
+    is set, and are memory-mapped when loaded from disk. Once the store holds at least
+    `ann_threshold` vectors, `save` also builds an IVF index that queries use instead of
+    the exact scan.
+    """
+    def __init__(
+        self,
+        embedder: Embedder,
+        path: Optional[str] = None,
+        quantize: bool = False,
+        ann_threshold: int = 50000,
+        n_probe: int = 8,
+        cache_size: int = 1024,
+        cache_ttl: float = 3600
+    ):
+        self.embedder = embedder
+        self.path = path
+        self.quantize = quantize
+        self.ann_threshold = ann_threshold
+        self.n_probe = n_probe
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.version = 0
+        self._rows: Dict[str, int] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._pending: list = []
+        self._ann: Optional[IVFIndex] = None
+        self._lock = threading.Lock()
+        # of the records file this store was loaded from or saved to, see `reloaded`
+        self._records_mtime: Optional[int] = None
+        self.query_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    @classmethod
+    def load(cls, path: str, embedder: Embedder, **kwargs) -> "LocalVectorStore":
+        """
+        Open a store saved with `save`, memory-mapping its vectors. A missing path gives an empty store.
+        """
+        store = cls(embedder=embedder, path=path, **kwargs)
+        records_file = os.path.join(path, "records.json")
+        store._records_mtime = _mtime(records_file)
+        if store._records_mtime is None:
+            return store
+
+        with open(records_file, encoding="utf-8") as f:
+            records = json.load(f)
+        store.ids, store.texts = records["ids"], records["texts"]
+        store.version = records.get("version", 0)
+        store.quantize = records.get("quantize", store.quantize)
+        store._rows = {id_: row for row, id_ in enumerate(store.ids)}
+        if store.ids:
+            store._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+            if store.quantize:
+                store._scales = np.load(os.path.join(path, "scales.npy"))
+        store._ann = IVFIndex.load(os.path.join(path, "ivf.npz"))
+        return store
+
+    def save(self, path: Optional[str] = None):
+        """
+        Write the store to `path`, bumping its version and (re)building the ANN index when large enough.
+
+        Files are written next to their target and swapped in with `os.replace`, so a store that
+        is currently memory-mapping the old files keeps reading a consistent snapshot.
+        """
+        path = path or self.path
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._save(path)
+
+    def _save(self, path: str):
+        self.version += 1
+        self._materialize()
+        ivf_file = os.path.join(path, "ivf.npz")
+        if self._vectors is not None:
+            _atomic_save(os.path.join(path, "vectors.npy"), np.ascontiguousarray(self._vectors))
+            if self._scales is not None:
+                _atomic_save(os.path.join(path, "scales.npy"), self._scales)
+        if len(self.ids) >= self.ann_threshold:
+            self._ann = IVFIndex.build(self._float_rows(np.arange(len(self.ids))))
+            self._ann.save(ivf_file)
+        elif os.path.exists(ivf_file):
+            os.remove(ivf_file)
+
+        records_file = os.path.join(path, "records.json")
+        with open(records_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "texts": self.texts, "version": self.version, "quantize": self.quantize}, f)
+        os.replace(records_file + ".tmp", records_file)
+        self._records_mtime = _mtime(records_file)
+        self.path = path
+
+    def reloaded(self) -> Optional["LocalVectorStore"]:
+        """
+        A fresh copy of the store when another process (the ingestion) saved it since it was
+        loaded, otherwise None. The copy shares the query embedding cache; this store is left
+        untouched, so searches already running on it finish on the old snapshot.
+        """
+        if not self.path or _mtime(os.path.join(self.path, "records.json")) == self._records_mtime:
+            return None
+        store = LocalVectorStore.load(self.path, embedder=self.embedder, quantize=self.quantize, ann_threshold=self.ann_threshold, n_probe=self.n_probe)
+        store.query_cache = self.query_cache
+        return store
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def embed(self, texts: List[str], input_type: str = "passage") -> List[List[float]]:
+        if input_type != "query":
+            return self.embedder(texts, input_type)
+
+        vectors = [self.query_cache.get(normalize_query(text)) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = self.embedder([texts[i] for i in missing], input_type)
+            for i, vector in zip(missing, embedded):
+                vectors[i] = list(vector)
+                self.query_cache.set(normalize_query(texts[i]), vectors[i])
+        return vectors
+
+    def _materialize(self, writable: bool = False):
+        """
+        Fold the appended blocks into the main matrix, copying it out of the memory map if it must be written to.
+        """
+        if self._pending:
+            blocks = ([self._vectors] if self._vectors is not None else []) + [block for block, _ in self._pending]
+            self._vectors = np.concatenate(blocks)
+            if self.quantize:
+                scales = ([self._scales] if self._scales is not None else []) + [block for _, block in self._pending]
+                self._scales = np.concatenate(scales)
+            self._pending = []
+        elif writable and isinstance(self._vectors, np.memmap):
+            self._vectors = np.array(self._vectors)
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str]) -> int:
+        """
+        Insert new ids and replace the ones whose text changed. Ids already stored with the same
+        text are skipped, so re-ingesting an unchanged corpus upserts nothing.
+        Returns:
+            int: the number of inserted or replaced vectors
+        """
+        with self._lock:
+            changed = [
+                position for position, (id_, text) in enumerate(zip(ids, texts))
+                if id_ not in self._rows or self.texts[self._rows[id_]] != text
+            ]
+        if not changed:
+            return 0
+        ids, texts = [ids[i] for i in changed], [texts[i] for i in changed]
+        matrix = _normalize(np.asarray([vectors[i] for i in changed], dtype=np.float32))
+        scales = None
+        if self.quantize:
+            matrix, scales = _quantize(matrix)
+
+        with self._lock:
+            self._upsert(ids, matrix, scales, texts)
+        return len(ids)
+
+    def _upsert(self, ids: List[str], matrix: np.ndarray, scales: Optional[np.ndarray], texts: List[str]):
+        new_rows, updated = [], []
+        for position, (id_, text) in enumerate(zip(ids, texts)):
+            row = self._rows.get(id_)
+            if row is None:
+                new_rows.append(position)
+                self._rows[id_] = len(self.ids)
+                self.ids.append(id_)
+                self.texts.append(text)
+            else:
+                updated.append((row, position))
+                self.texts[row] = text
+
+        if updated:
+            self._materialize(writable=True)
+            for row, position in updated:
+                self._vectors[row] = matrix[position]
+                if scales is not None:
+                    self._scales[row] = scales[position]
+        if new_rows:
+            # appended blocks are only concatenated when the matrix is next read, so batched upserts stay linear
+            self._pending.append((matrix[new_rows], scales[new_rows] if scales is not None else None))
+        # the ANN lists no longer cover every row, fall back to exact search until the next save
+        self._ann = None
+
+    def prune(self, keep: Set[str]) -> int:
+        """
+        Delete the vectors whose id is not in `keep`, e.g. chunks that were edited or removed.
+        Returns:
+            int: the number of deleted vectors
+        """
+        with self._lock:
+            self._materialize()
+            rows = [row for row, id_ in enumerate(self.ids) if id_ in keep]
+            removed = len(self.ids) - len(rows)
+            if not removed:
+                return 0
+            kept = np.asarray(rows, dtype=np.int64)
+            self._vectors = np.array(self._vectors[kept]) if rows else None
+            if self._scales is not None:
+                self._scales = self._scales[kept] if rows else None
+            self.ids = [self.ids[row] for row in rows]
+            self.texts = [self.texts[row] for row in rows]
+            self._rows = {id_: row for row, id_ in enumerate(self.ids)}
+            self._ann = None
+        return removed
+
+    def _float_rows(self, rows: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[rows][:, None]
+        return vectors
+
+    def _score(self, vector: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        if rows is not None:
+            return self._float_rows(rows) @ vector
+        if self._scales is None:
+            return np.asarray(self._vectors @ vector)
+        return np.concatenate([
+            (np.asarray(self._vectors[start:start + BLOCK_SIZE], dtype=np.float32) @ vector) * self._scales[start:start + BLOCK_SIZE]
+            for start in range(0, len(self.ids), BLOCK_SIZE)
+        ])
+
+    def query(self, vector: List[float], top_k: int = 3) -> List[ScoredDocument]:
+        if not self.ids:
+            return []
+        if self._pending:
+            with self._lock:
+                self._materialize()
+        vector = _normalize(np.asarray(vector, dtype=np.float32))
+        with span(RETRIEVER_LATENCY, "local_query"):
+            rows = self._ann.candidates(vector, self.n_probe) if self._ann is not None else None
+            scores = self._score(vector, rows)
+            best = _top_k(scores, top_k)
+        matched = rows[best] if rows is not None else best
+        vectors = self._float_rows(matched)
+        return [
+            {"id": self.ids[row], "text": self.texts[row], "score": float(score), "embedding": vector.tolist()}
+            for row, score, vector in zip(matched, scores[best], vectors)
+        ]
+
+    def search_matching(self, query: str, top_k: int = 3, **kwargs) -> List[ScoredDocument]:
+        vector = self.embed([query], input_type="query")[0]
+        return self.query(vector, top_k=top_k)
+
+    async def asearch_matching(self, query: str, top_k: int = 3, **kwargs) -> List[ScoredDocument]:
+        # the scan itself is cpu bound, but the embedder may make a network call
+        return await asyncio.to_thread(self.search_matching, query=query, top_k=top_k)
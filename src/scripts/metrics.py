@@ -0,0 +1,146 @@
+"""
+Prometheus metrics, timing spans and per-request trace ids.
+
+Metrics live in the default `prometheus_client` registry and are exposed by the `/metrics`
+route. Logs carry the trace id of the request they were written for, set by the
+`trace_requests` middleware from the `X-Request-ID` header (or a fresh id).
+"""
+import os
+import time
+import uuid
+import inspect
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Optional
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a cache hit up to a slow multi-rewrite LLM request
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram("rag_http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+NODE_LATENCY = Histogram("rag_node_duration_seconds", "Latency of a graph node", ["node"], buckets=LATENCY_BUCKETS)
+LLM_LATENCY = Histogram("rag_llm_duration_seconds", "Latency of an LLM chain call", ["chain"], buckets=LATENCY_BUCKETS)
+RETRIEVER_LATENCY = Histogram("rag_retriever_duration_seconds", "Latency of an embedding or vector store call", ["operation"], buckets=LATENCY_BUCKETS)
+JOB_LATENCY = Histogram("rag_background_job_duration_seconds", "Latency of a background job", ["job"], buckets=LATENCY_BUCKETS)
+MONGO_LATENCY = Histogram("rag_mongo_duration_seconds", "Latency of a MongoDB call", ["operation"], buckets=LATENCY_BUCKETS)
+SPAN_ERRORS = Counter("rag_span_errors_total", "Timed calls that raised", ["span"])
+
+REWRITES = Counter("rag_rewrites_total", "Question rewrites performed")
+SPECULATIONS = Counter("rag_speculative_rewrites_total", "Speculative rewrites, by whether they were used", ["outcome"])
+ROUTING_DECISIONS = Counter("rag_routing_decisions_total", "Decisions taken after grading", ["decision"])
+LLM_CONCURRENCY_LIMIT = Gauge("rag_llm_concurrency_limit", "Adaptive limit of LLM requests in flight", ["model"])
+LLM_THROTTLED = Counter("rag_llm_throttled_total", "LLM requests answered with a 429", ["model"])
+LLM_HEDGES = Counter("rag_llm_hedges_total", "Hedged LLM requests sent, and won by the hedge", ["outcome"])
+GRADING_PATHS = Counter("rag_graded_documents_total", "Documents graded, by how the verdict was reached", ["path"])
+COALESCED_REQUESTS = Counter("rag_coalesced_requests_total", "Questions by their part in single-flight coalescing", ["role"])
+
+TRACE_ID: contextvars.ContextVar = contextvars.ContextVar("trace_id", default="-")
+
+
+@contextmanager
+def span(histogram: Histogram, label: str):
+    """
+    Time the enclosed block into `histogram`, labelled with `label`.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        SPAN_ERRORS.labels(label).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.labels(label).observe(elapsed)
+        logger.debug("%s took %.1fms", label, elapsed * 1000)
+
+
+def timed(histogram: Histogram, label: str):
+    """
+    Decorator version of `span`, for both plain and async functions.
+    """
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(histogram, label):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(histogram, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class CacheCollector:
+    """
+    Exposes the hit/miss counters and sizes of the registered `TTLCache`s.
+    """
+    def __init__(self):
+        self.caches: Dict[str, object] = {}
+
+    def collect(self):
+        hits = CounterMetricFamily("rag_cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily("rag_cache_misses", "Cache misses", labels=["cache"])
+        size = GaugeMetricFamily("rag_cache_entries", "Entries held by the cache", labels=["cache"])
+        for name, cache in list(self.caches.items()):
+            stats = cache.stats()
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            size.add_metric([name], stats["size"])
+        yield hits
+        yield misses
+        yield size
+
+
+CACHE_COLLECTOR = CacheCollector()
+REGISTRY.register(CACHE_COLLECTOR)
+
+
+def register_cache(name: str, cache: Optional[object]):
+    if cache is not None:
+        CACHE_COLLECTOR.caches[name] = cache
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = TRACE_ID.get()
+        return True
+
+
+def configure_logging(level: Optional[str] = None):
+    """
+    Log to stderr with the request trace id, at `LOG_LEVEL` (INFO by default).
+    """
+    handler = logging.StreamHandler()
+    handler.addFilter(TraceIdFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level or os.environ.get("LOG_LEVEL", "INFO"))
+
+
+async def trace_requests(request, call_next):
+    """
+    HTTP middleware assigning the request a trace id and timing it.
+    """
+    trace_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    token = TRACE_ID.set(trace_id)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = trace_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, getattr(route, "path", "unmatched"), str(status)).observe(time.perf_counter() - started)
+        TRACE_ID.reset(token)
@@ -0,0 +1,104 @@
+"""
+Convert chat documents holding their whole `conversation_history` array into the bucketed
+layout: a small user document plus fixed-size message buckets in `chat-messages`.
+
+Run it once before starting a version of the API using the bucketed layout. It is safe to
+re-run, documents are only converted while they still carry `conversation_history` and
+their buckets are replaced rather than appended to. Summaries stored as the legacy
+`(summary, recent_messages)` array are rewritten to the plain summary string.
+
+Usage (from `src/`):
+    python -m scripts.migrate_chat_storage
+"""
+import argparse
+from pymongo import ReplaceOne
+from scripts.chat_persistence_service import (
+    BUCKET_SIZE,
+    chat_collection,
+    count_message_tokens,
+    ensure_indexes,
+    get_token_count,
+    message_collection,
+    summary_text
+)
+
+# documents still in the legacy layout, either with the whole history or with an array summary
+LEGACY_QUERY = {'$or': [{'conversation_history': {'$exists': True}}, {'conversation_summary': {'$type': 'array'}}]}
+
+
+def _summary_update(user_chat):
+    summary = user_chat.get('conversation_summary')
+    if isinstance(summary, (list, tuple)):
+        return {'conversation_summary': summary_text(summary)}
+    return {}
+
+def migrate_document(user_chat, dry_run=False):
+    """
+    Returns:
+        int: the number of messages moved to buckets
+    """
+    user_id = user_chat['user_id']
+    if 'conversation_history' not in user_chat:
+        # already bucketed, only the summary is left to fix
+        summary = _summary_update(user_chat)
+        if summary and not dry_run:
+            chat_collection.update_one({'_id': user_chat['_id']}, {'$set': summary, '$inc': {'version': 1}})
+        return 0
+    messages = []
+    for seq, msg in enumerate(user_chat.get('conversation_history') or []):
+        msg = {**msg, 'seq': seq}
+        msg.setdefault('token_count', count_message_tokens(msg))
+        messages.append(msg)
+    recent_messages = [
+        {**msg, 'token_count': msg.get('token_count', count_message_tokens(msg))}
+        for msg in user_chat.get('recent_messages', [])
+    ]
+    if dry_run:
+        return len(messages)
+
+    buckets = [
+        ReplaceOne(
+            {'user_id': user_id, 'bucket': start // BUCKET_SIZE},
+            {'user_id': user_id, 'bucket': start // BUCKET_SIZE, 'messages': messages[start:start + BUCKET_SIZE]},
+            upsert=True
+        )
+        for start in range(0, len(messages), BUCKET_SIZE)
+    ]
+    if buckets:
+        message_collection.bulk_write(buckets, ordered=False)
+    chat_collection.update_one(
+        {'_id': user_chat['_id']},
+        {
+            '$set': {
+                'recent_messages': recent_messages,
+                'message_count': len(messages),
+                'summarized_count': 0,
+                'token_count': get_token_count(recent_messages + messages),
+                **_summary_update(user_chat)
+            },
+            '$inc': {'version': 1},
+            '$unset': {'conversation_history': ''}
+        }
+    )
+    return len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move chat histories into bucketed message storage")
+    parser.add_argument("--dry-run", action="store_true", help="only count the documents and messages to migrate")
+    args = parser.parse_args()
+
+    if not args.dry_run:
+        ensure_indexes()
+    documents = 0
+    messages = 0
+    for user_chat in chat_collection.find(LEGACY_QUERY):
+        messages += migrate_document(user_chat, dry_run=args.dry_run)
+        documents += 1
+        if documents % 100 == 0:
+            print(f"{documents} documents, {messages} messages", flush=True)
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {documents} documents, {messages} messages")
+
+
+if __name__ == "__main__":
+    main()
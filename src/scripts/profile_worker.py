@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from scripts import chat_persistence_service as persistence
+from scripts.metrics import JOB_LATENCY, span
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileWorker:
+    """
+    Periodically runs the LLM fallback of the user details extraction in the background of
+    the API process.
+
+    Summarization only matches the new messages against the precompiled patterns and marks
+    the users they found nothing for. Every `interval` seconds the marked users are leased
+    and handled `batch_size` at a time, one LLM call per batch, until none are left. The
+    leases let several API replicas run a worker against the same database.
+    """
+    def __init__(self, interval: float = 30.0, batch_size: int = persistence.DETAILS_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+        self._stopping = None
+
+    async def run_once(self) -> int:
+        """
+        Process one batch. Returns the number of users processed.
+        """
+        with span(JOB_LATENCY, "user_details"):
+            return await persistence.aextract_pending_details(self.batch_size)
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                # a full batch means more users may be waiting
+                while await self.run_once() >= self.batch_size and not self._stopping.is_set():
+                    pass
+            except Exception as e:
+                logger.warning("User details extraction failed, retrying in %ss: %s", self.interval, e)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        # created here so the event binds to the running loop on python < 3.10
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
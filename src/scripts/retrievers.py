@@ -0,0 +1,95 @@
+import os
+from typing import List, Optional
+from typing_extensions import NotRequired, Protocol, TypedDict
+from dotenv import load_dotenv, find_dotenv
+
+
+class ScoredDocument(TypedDict):
+    """
+    A document returned by a vector query.
+
+    Attributes:
+        id: the vector id
+        text: the chunk text stored alongside the vector
+        score: the similarity score of the match, None when only the lexical index found it
+        rrf_score: the reciprocal-rank fusion score, set by the hybrid retriever
+        embedding: the stored vector of the chunk, when the vector store returns it
+    """
+    id: str
+    text: str
+    score: Optional[float]
+    rrf_score: NotRequired[float]
+    embedding: NotRequired[List[float]]
+
+
+class Retriever(Protocol):
+    """
+    The operations the RAG workflow and the ingestion tooling need from a vector store.
+    """
+    def embed(self, texts: List[str], input_type: str = "passage") -> List[List[float]]:
+        """Embed `texts` as passages (for upserts) or queries (for searches)."""
+        ...
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str]) -> int:
+        """Insert or replace vectors and their texts, returns the number of upserted vectors."""
+        ...
+
+    def query(self, vector: List[float], top_k: int = 3) -> List[ScoredDocument]:
+        """Return the `top_k` documents most similar to `vector`."""
+        ...
+
+    def search_matching(self, query: str, top_k: int = 3) -> List[ScoredDocument]:
+        """Embed `query` and return the best matching documents with their scores."""
+        ...
+
+    async def asearch_matching(self, query: str, top_k: int = 3) -> List[ScoredDocument]:
+        """Async version of `search_matching`."""
+        ...
+
+
+def create_retriever(backend: str = None, local_index_path: str = None, embedding_cache_dir: str = None, bm25_index_path: str = None, rebuild_bm25: bool = False) -> Retriever:
+    """
+    Create the retriever selected by `RETRIEVER_BACKEND`, either `pinecone` or `local`.
+
+    The local backend embeds with Pinecone inference by default, or entirely offline
+    with the hashing embedder when `LOCAL_EMBEDDER=hashing`. When `BM25_INDEX_PATH` is set
+    the retriever is wrapped in a `HybridRetriever` fusing dense and BM25 results.
+    Args:
+        backend: overrides `RETRIEVER_BACKEND`
+        local_index_path: overrides `LOCAL_INDEX_PATH`
+        embedding_cache_dir: directory of the on-disk passage embedding cache, used by ingestion
+        bm25_index_path: overrides `BM25_INDEX_PATH`
+        rebuild_bm25: start from an empty BM25 index instead of loading the saved one
+    """
+    # imported here, both backends import this module for the protocol types
+    from scripts.embedding_service import PineconeEmbeddingManager
+    from scripts.local_vector_store import LocalVectorStore, HashingEmbedder
+    from scripts.embedding_cache import EmbeddingCache
+    from scripts.bm25 import BM25Index, HybridRetriever
+
+    load_dotenv(find_dotenv())
+    backend = backend or os.environ.get('RETRIEVER_BACKEND', 'pinecone')
+    local_index_path = local_index_path or os.environ.get('LOCAL_INDEX_PATH', 'data/index')
+    bm25_index_path = bm25_index_path or os.environ.get('BM25_INDEX_PATH')
+
+    def pinecone_manager():
+        return PineconeEmbeddingManager(
+            api_key=os.environ.get('PINECONE_API_KEY'),
+            index_name=os.environ.get('INDEX_NAME') or 'kifiya',
+            name_space=os.environ.get('NAMESPACE') or 'test',
+            embedding_cache=EmbeddingCache(embedding_cache_dir) if embedding_cache_dir else None
+        )
+
+    if backend == 'local':
+        if os.environ.get('LOCAL_EMBEDDER', 'pinecone') == 'hashing':
+            embedder = HashingEmbedder()
+        else:
+            embedder = pinecone_manager().embed
+        retriever = LocalVectorStore.load(local_index_path, embedder=embedder)
+    else:
+        retriever = pinecone_manager()
+
+    if bm25_index_path:
+        lexical = BM25Index() if rebuild_bm25 else BM25Index.load(bm25_index_path)
+        retriever = HybridRetriever(retriever, lexical, lexical_path=bm25_index_path)
+    return retriever
@@ -0,0 +1,106 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+import numpy as np
+from scripts.cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """
+    A thread-safe LRU cache of answers looked up by question embedding rather than by exact text.
+
+    A lookup matches the most similar cached question by cosine similarity and is a hit when
+    the similarity is at least `threshold`. Entries expire after `ttl` seconds, and every call
+    carries the current corpus version: answers cached for another version are dropped.
+    """
+    def __init__(self, threshold: float = 0.95, maxsize: int = 1024, ttl: Optional[float] = 86400, timer: Callable[[], float] = time.monotonic):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.version: Optional[Hashable] = None
+        # normalized question -> row of `_vectors`, in least recently used order
+        self._rows: "OrderedDict[str, int]" = OrderedDict()
+        self._entries: List[Optional[tuple]] = [None] * maxsize
+        self._vectors: Optional[np.ndarray] = None
+        self._valid = np.zeros(maxsize, dtype=bool)
+        self._free = list(range(maxsize - 1, -1, -1))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _clear(self):
+        self._rows.clear()
+        self._entries = [None] * self.maxsize
+        self._valid[:] = False
+        self._free = list(range(self.maxsize - 1, -1, -1))
+
+    def _check_version(self, version: Optional[Hashable]):
+        if version != self.version:
+            if self._rows:
+                logger.info("Corpus version changed to %s, dropping %d cached answers", version, len(self._rows))
+            self._clear()
+            self.version = version
+
+    def _remove(self, question: str):
+        row = self._rows.pop(question)
+        self._entries[row] = None
+        self._valid[row] = False
+        self._free.append(row)
+
+    def get(self, vector: List[float], version: Optional[Hashable] = None, default: Any = None) -> Any:
+        query = self._unit(vector)
+        with self._lock:
+            self._check_version(version)
+            if self._rows and self._vectors is not None and self._vectors.shape[1] == query.shape[0]:
+                scores = np.where(self._valid, self._vectors @ query, -np.inf)
+                row = int(np.argmax(scores))
+                if scores[row] >= self.threshold:
+                    question, value, expires_at = self._entries[row]
+                    if expires_at is None or expires_at > self.timer():
+                        self._rows.move_to_end(question)
+                        self.hits += 1
+                        return value
+                    self._remove(question)
+            self.misses += 1
+            return default
+
+    def set(self, question: str, vector: List[float], value: Any, version: Optional[Hashable] = None) -> None:
+        key = normalize_query(question)
+        unit = self._unit(vector)
+        expires_at = self.timer() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._check_version(version)
+            if self._vectors is None or self._vectors.shape[1] != unit.shape[0]:
+                # a different embedding model, the cached vectors can't be compared anymore
+                self._clear()
+                self._vectors = np.zeros((self.maxsize, unit.shape[0]), dtype=np.float32)
+            if key in self._rows:
+                self._remove(key)
+            if not self._free:
+                self._remove(next(iter(self._rows)))
+            row = self._free.pop()
+            self._rows[key] = row
+            self._entries[row] = (key, value, expires_at)
+            self._vectors[row] = unit
+            self._valid[row] = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._rows)}
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument
+from scripts import chat_persistence_service as persistence
+from scripts.metrics import JOB_LATENCY, MONGO_LATENCY, span
+
+logger = logging.getLogger(__name__)
+
+
+class SummarizationWorker:
+    """
+    Drains the `summarization-jobs` collection in the background of the API process.
+
+    Jobs are claimed atomically with a lease, so several API replicas can run a worker
+    against the same database, and a job whose worker died is picked up again once its
+    lease expires. A failed job is retried up to `max_attempts` times.
+    """
+    def __init__(self, poll_interval: float = 1.0, lease_seconds: float = 300, max_attempts: int = 3):
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._task = None
+        self._stopping = None
+
+    async def ensure_indexes(self):
+        jobs = persistence.async_job_collection
+        # at most one pending job per user, so bursts of messages coalesce into one summarization
+        await jobs.create_index(
+            [("user_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"status": "pending"},
+            name="one_pending_job_per_user"
+        )
+        await jobs.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+
+    async def claim(self):
+        """
+        Lease the oldest pending job, or a running job whose lease expired.
+        """
+        now = datetime.utcnow()
+        with span(MONGO_LATENCY, "claim_job"):
+            return await persistence.async_job_collection.find_one_and_update(
+                {"$or": [
+                    {"status": "pending"},
+                    {"status": "running", "lease_expires": {"$lt": now}}
+                ]},
+                {
+                    "$set": {"status": "running", "lease_expires": now + timedelta(seconds=self.lease_seconds)},
+                    "$inc": {"attempts": 1}
+                },
+                sort=[("created_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+
+    async def process(self, job):
+        jobs = persistence.async_job_collection
+        try:
+            with span(JOB_LATENCY, "summarization"):
+                await persistence.asummarize_user_history(job["user_id"])
+        except Exception as e:
+            logger.warning("Summarization of %s failed (attempt %d): %s", job["user_id"], job["attempts"], e)
+            if job["attempts"] >= self.max_attempts:
+                await jobs.update_one({"_id": job["_id"]}, {"$set": {"status": "failed", "error": str(e)}})
+                return
+            if await jobs.find_one({"user_id": job["user_id"], "status": "pending"}, {"_id": 1}):
+                # a newer job for the user will retry anyway
+                await jobs.delete_one({"_id": job["_id"]})
+            else:
+                await jobs.update_one({"_id": job["_id"]}, {"$set": {"status": "pending"}, "$unset": {"lease_expires": ""}})
+            return
+        await jobs.delete_one({"_id": job["_id"]})
+
+    async def run_once(self) -> bool:
+        """
+        Process one job. Returns whether there was a job to process.
+        """
+        job = await self.claim()
+        if job is None:
+            return False
+        await self.process(job)
+        return True
+
+    async def run(self):
+        try:
+            await self.ensure_indexes()
+        except Exception as e:
+            logger.warning("Could not create the summarization job indexes: %s", e)
+        while not self._stopping.is_set():
+            try:
+                if await self.run_once():
+                    continue
+            except Exception as e:
+                logger.exception("Summarization worker error: %s", e)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        # created here so the event binds to the running loop on python < 3.10
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
@@ -0,0 +1,35 @@
+"""
+Token counting shared by the conversation history accounting and the context packing.
+
+Counts use the tiktoken encoding of MODEL_NAME. When it can't be loaded (tiktoken downloads
+its BPE ranks the first time it runs, which fails offline or behind restricted egress) they
+are estimated from the text length, so nothing on the request path fails on counting tokens.
+"""
+import os
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def encoding():
+    """
+    The tokenizer, None when it can't be loaded. Loaded once, by the startup warmup or the first count.
+    """
+    import tiktoken
+    try:
+        try:
+            return tiktoken.encoding_for_model(os.environ.get('MODEL_NAME') or "gpt-3.5-turbo")
+        except KeyError:
+            # not an OpenAI model, its token counts are approximated
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("tiktoken is unavailable (%s), estimating tokens from the text length", e)
+        return None
+
+def count_tokens(text: str) -> int:
+    tokenizer = encoding()
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text, disallowed_special=()))
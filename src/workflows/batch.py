@@ -0,0 +1,75 @@
+"""
+Answer many questions in one go, for evaluation and bulk-answer jobs.
+
+The query embeddings of the whole batch are computed up front in as few embedding calls as
+the retriever allows, which fills its query cache so every retrieval of the batch is a cache
+hit. The graph then runs over all the questions with `abatch`, at most `max_concurrency` at
+a time, so the vector queries, gradings and generations of different questions overlap.
+"""
+import os
+import asyncio
+import logging
+from typing import Any, List, Optional
+from workflows import graphs
+from workflows.graphs import workflow
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_CONCURRENCY = int(os.environ.get('RAG_BATCH_MAX_CONCURRENCY', 8))
+
+_app = None
+
+def _default_graph():
+    global _app
+    if _app is None:
+        _app = workflow.compile()
+    return _app
+
+def _inputs(questions: List[str], user_id: Optional[str], history: Any) -> List[dict]:
+    return [{"prompt": question, "user_id": user_id, "conversation_history": history} for question in questions]
+
+def _result(output) -> dict:
+    # a failed question only fails its own entry
+    if isinstance(output, Exception):
+        logger.warning("Batch question failed: %r", output)
+        return {"error": repr(output)}
+    return {"generation": output["generation"]}
+
+def _config(max_concurrency: Optional[int]) -> dict:
+    return {"max_concurrency": min(max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)}
+
+def _prime_query_cache(questions: List[str]):
+    try:
+        graphs.manager.embed(questions, input_type="query")
+    except Exception as e:
+        # the retrievals will embed their own query
+        logger.warning("Could not embed the batch of questions: %s", e)
+
+def batch_answer(questions: List[str], user_id: Optional[str] = None, history: Any = None, max_concurrency: Optional[int] = None, graph=None) -> List[dict]:
+    """
+    Answer `questions`, returning one `{"generation": ...}` or `{"error": ...}` per question, in input order.
+
+    Args:
+        questions: the questions to answer
+        user_id: the user the questions are asked for, if any
+        history: the conversation history handed to the persona step
+        max_concurrency: questions in flight, capped by `RAG_BATCH_MAX_CONCURRENCY`
+        graph: the compiled graph to run, the default workflow otherwise
+    """
+    if not questions:
+        return []
+    graph = graph or _default_graph()
+    _prime_query_cache(questions)
+    outputs = graph.batch(_inputs(questions, user_id, history), config=_config(max_concurrency), return_exceptions=True)
+    return [_result(output) for output in outputs]
+
+async def abatch_answer(questions: List[str], user_id: Optional[str] = None, history: Any = None, max_concurrency: Optional[int] = None, graph=None) -> List[dict]:
+    """
+    Async version of `batch_answer`.
+    """
+    if not questions:
+        return []
+    graph = graph or _default_graph()
+    await asyncio.to_thread(_prime_query_cache, questions)
+    outputs = await graph.abatch(_inputs(questions, user_id, history), config=_config(max_concurrency), return_exceptions=True)
+    return [_result(output) for output in outputs]
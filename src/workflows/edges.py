@@ -1,18 +1,27 @@
+import logging
 from workflows.states import RAGState
+from scripts.metrics import ROUTING_DECISIONS
 
-def decide_to_generate(state: RAGState, max_rewrites: int = 1) -> str:
-    print("---INSPECT THE GRADED DOCUMENTS---")
+logger = logging.getLogger(__name__)
+
+MAX_REWRITES = 1
+
+def decide_to_generate(state: RAGState, max_rewrites: int = MAX_REWRITES) -> str:
+    logger.debug("---INSPECT THE GRADED DOCUMENTS---")
     filtered_documents = state.get("documents", [])
 
     if not filtered_documents:
         rewrite_count = state.get("rewrite_count", 0)
         if rewrite_count >= max_rewrites:
-            print("---DECISION: GENERATE REACHED MAX QUESTION REWRITE---")
+            logger.debug("---DECISION: GENERATE REACHED MAX QUESTION REWRITE---")
+            ROUTING_DECISIONS.labels("max_rewrites").inc()
             return "answer_generator"
         else:
-            print("---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---")
+            logger.debug("---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---")
+            ROUTING_DECISIONS.labels("rewrite").inc()
             return "rewriter"
     else:
-        print("---DECISION: GENERATE---")
+        logger.debug("---DECISION: GENERATE---")
+        ROUTING_DECISIONS.labels("generate").inc()
         return "answer_generator"
 
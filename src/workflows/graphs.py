@@ -1,45 +1,182 @@
 import os
+import time
+import asyncio
+import logging
+import threading
 from dotenv import load_dotenv, find_dotenv
-from workflows.nodes import generate_response, retrieve_documents, grade_documents, transform_query, generate_assistant_response
-from workflows.edges import decide_to_generate
-from workflows.agents import document_grader, prompt_rewriter, answer_generator, assistant
+from workflows.nodes import generate_response, retrieve_documents, grade_documents, transform_query, generate_assistant_response, generate_fused_response
+from workflows.nodes import agenerate_response, aretrieve_documents, agrade_documents, atransform_query, agenerate_assistant_response, agenerate_fused_response
+from workflows.nodes import GradingPolicy, aspeculate_rewrite, assemble_context_node, aassemble_context_node
+from workflows.edges import MAX_REWRITES, decide_to_generate
+from workflows.agents import document_grader, prompt_rewriter, answer_generator, assistant, fused_assistant
 from workflows.states import RAGState, InputState, OutputState
-from scripts.embedding_service import PineconeEmbeddingManager
+from scripts.retrievers import create_retriever
+from scripts.metrics import NODE_LATENCY, register_cache, timed
+from scripts.container import Lazy
+from scripts.corpus_version import acorpus_version as acorpus_shared_version
 from langgraph.graph import START, END, StateGraph
+from langchain_core.runnables import RunnableLambda
 
 
+logger = logging.getLogger(__name__)
+
 # load environment variables
 load_dotenv(find_dotenv())
-api_key = os.environ.get('PINECONE_API_KEY')
-index_name = os.environ.get('INDEX_NAME')
-name_space = os.environ.get('NAMESPACE')
 
-# instantiate the Pinecone Manager
-manager = PineconeEmbeddingManager(api_key=api_key, index_name='kifiya', name_space='test')
+def _create_manager():
+    retriever = create_retriever()
+    register_cache("query_embeddings", getattr(getattr(retriever, "dense", retriever), "query_cache", None))
+    return retriever
+
+# the retriever is instantiated on first use
+manager = Lazy(_create_manager)
+
+# seconds between checks of the on-disk indexes (local store, BM25) for a newer ingestion
+RETRIEVER_REFRESH_INTERVAL = float(os.environ.get('RETRIEVER_REFRESH_INTERVAL', 5))
+_refresh_lock = threading.Lock()
+_last_refresh = {"at": 0.0, "version": None}
+
+def refresh_manager(force: bool = False):
+    """
+    Swap in fresh copies of the retriever's on-disk indexes when an ingestion saved them since
+    they were loaded, checked at most every RETRIEVER_REFRESH_INTERVAL seconds unless `force`.
+    Searches already running finish on the old copies. Pinecone has nothing to reload.
+    """
+    with _refresh_lock:
+        now = time.monotonic()
+        if not force and now - _last_refresh["at"] < RETRIEVER_REFRESH_INTERVAL:
+            return
+        _last_refresh["at"] = now
+        if not isinstance(manager, Lazy) or not manager.created:
+            return
+        reloaded = getattr(manager, "reloaded", None)
+        fresh = reloaded() if callable(reloaded) else None
+        if fresh is not None:
+            manager.replace(fresh)
+            logger.info("Reloaded the retriever indexes saved by an ingestion")
+
+async def arefresh_manager(force: bool = False):
+    """
+    Async version of `refresh_manager`, the check only leaves the event loop when it is due.
+    """
+    if force or time.monotonic() - _last_refresh["at"] >= RETRIEVER_REFRESH_INTERVAL:
+        await asyncio.to_thread(refresh_manager, force)
+
+async def acorpus_version():
+    """
+    The version of the indexed corpus: the shared version bumped by every ingestion, plus
+    `CORPUS_VERSION` for a manual bump. Answers cached for another version are stale.
+    """
+    version = await acorpus_shared_version()
+    if version != _last_refresh["version"]:
+        # answers cached under the new version must come from the new indexes
+        await arefresh_manager(force=True)
+        _last_refresh["version"] = version
+    return (os.environ.get('CORPUS_VERSION'), version)
+
+def _optional_float(name: str):
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+# similarity thresholds outside of which documents are accepted/rejected without the LLM grader
+grading_policy = GradingPolicy(
+    accept_score=_optional_float('GRADE_ACCEPT_SCORE'),
+    reject_score=_optional_float('GRADE_REJECT_SCORE')
+)
+
+# how the graded documents are turned into the context of the answer prompt
+context_options = {
+    "token_budget": int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500)),
+    "lambda_mult": float(os.environ.get('CONTEXT_MMR_LAMBDA', 0.7)),
+    "dedupe_threshold": float(os.environ.get('CONTEXT_DEDUPE_THRESHOLD', 0.95))
+}
+
+# start the rewrite ("rewrite") or the rewrite and its retrieval ("retrieve") while the documents
+# are graded, saving a round-trip when they are rejected at the cost of wasted calls when they aren't.
+# only the async graph speculates
+SPECULATIVE_REWRITE = os.environ.get('SPECULATIVE_REWRITE', 'off').lower()
+
+def _speculation(state, config):
+    if SPECULATIVE_REWRITE not in ('rewrite', 'retrieve') or state.get('rewrite_count', 0) >= MAX_REWRITES:
+        return None
+    return aspeculate_rewrite(
+        state=state,
+        prompt_rewriter=prompt_rewriter,
+        retriever=manager if SPECULATIVE_REWRITE == 'retrieve' else None,
+        config=config
+    )
 
 # define the graph nodes
-retriever = lambda state: retrieve_documents(state=state, retriever=manager)    
-grader = lambda state: grade_documents(state=state, document_grader=document_grader)
+def retriever(state):
+    refresh_manager()
+    return retrieve_documents(state=state, retriever=manager)
+grader = lambda state: grade_documents(state=state, document_grader=document_grader, policy=grading_policy)
 rewriter = lambda state: transform_query(state=state, prompt_rewriter=prompt_rewriter)
+context_assembler = lambda state: assemble_context_node(state=state, **context_options)
 generator = lambda state: generate_response(state=state, answer_generator=answer_generator)
 assistant_node = lambda state: generate_assistant_response(state=state, assistant=assistant)
+fused_node = lambda state: generate_fused_response(state=state, fused_assistant=fused_assistant)
+
+# async variants of the graph nodes, used when the graph is driven with `ainvoke`/`astream`.
+# the config is passed down explicitly so callbacks (and token streaming) propagate on python < 3.11
+async def aretriever(state):
+    await arefresh_manager()
+    return await aretrieve_documents(state=state, retriever=manager)
+async def agrader(state, config): return await agrade_documents(state=state, document_grader=document_grader, config=config, policy=grading_policy, speculation=_speculation(state, config))
+async def arewriter(state, config): return await atransform_query(state=state, prompt_rewriter=prompt_rewriter, config=config)
+async def acontext_assembler(state): return await aassemble_context_node(state=state, **context_options)
+async def agenerator(state, config): return await agenerate_response(state=state, answer_generator=answer_generator, config=config)
+async def aassistant_node(state, config): return await agenerate_assistant_response(state=state, assistant=assistant, config=config)
+async def afused_node(state, config): return await agenerate_fused_response(state=state, fused_assistant=fused_assistant, config=config)
+
+def _node(name, func, afunc):
+    # both variants are timed into the node latency histogram
+    return RunnableLambda(timed(NODE_LATENCY, name)(func), afunc=timed(NODE_LATENCY, name)(afunc))
+
+# "two_stage" answers from the documents, then rewrites the answer with the KAVAS persona;
+# "fused" does both in a single LLM call
+PIPELINE_PROFILES = ("two_stage", "fused")
+PIPELINE_PROFILE = os.environ.get('PIPELINE_PROFILE', 'two_stage')
+
+def build_workflow(profile: str = PIPELINE_PROFILE) -> StateGraph:
+    """
+    Build the RAG graph of the given pipeline profile. Either way the answer is produced by the `assistant` node.
+    """
+    if profile not in PIPELINE_PROFILES:
+        raise ValueError(f"Unknown pipeline profile {profile!r}, expected one of {PIPELINE_PROFILES}")
+
+    # create a workflow/graph
+    workflow = StateGraph(RAGState, input=InputState, output=OutputState)
+
+    # register the nodes to the workflow/graph
+    workflow.add_node("retrieve", _node("retrieve", retriever, aretriever))
+    workflow.add_node("rewriter", _node("rewriter", rewriter, arewriter))
+    workflow.add_node("grade_documents", _node("grade_documents", grader, agrader))
+    workflow.add_node("assemble_context", _node("assemble_context", context_assembler, acontext_assembler))
+
+    # add edges
+    workflow.add_edge(START, "retrieve")
+    workflow.add_edge("retrieve", "grade_documents")
+    workflow.add_edge("rewriter", "retrieve")
+    workflow.add_edge("assistant", END)
+
+    if profile == "fused":
+        workflow.add_node("assistant", _node("assistant", fused_node, afused_node))
+        # generating goes straight to the fused assistant
+        workflow.add_edge("assemble_context", "assistant")
+    else:
+        workflow.add_node("answer_generator", _node("answer_generator", generator, agenerator))
+        workflow.add_node("assistant", _node("assistant", assistant_node, aassistant_node))
+        workflow.add_edge("assemble_context", "answer_generator")
+        workflow.add_edge("answer_generator", "assistant")
+
+    # add conditional edges, the context is assembled before generating
+    workflow.add_conditional_edges(
+        source="grade_documents",
+        path=decide_to_generate,
+        path_map={"answer_generator": "assemble_context", "rewriter": "rewriter"}
+    )
+
+    return workflow
 
-# create a workflow/graph
-workflow = StateGraph(RAGState, input=InputState, output=OutputState)
-
-# register the nodes to the workflow/graph
-workflow.add_node("retrieve", retriever)
-workflow.add_node("rewriter", rewriter)
-workflow.add_node("grade_documents", grader)
-workflow.add_node("answer_generator", generator)
-workflow.add_node("assistant", assistant_node)
-
-# add edges
-workflow.add_edge(START, "retrieve")
-workflow.add_edge("retrieve", "grade_documents")
-workflow.add_edge("rewriter", "retrieve")
-workflow.add_edge("answer_generator", "assistant")
-workflow.add_edge("assistant", END)
-
-# add conditional edges
-workflow.add_conditional_edges(source="grade_documents", path=decide_to_generate)
+workflow = build_workflow()
@@ -0,0 +1,97 @@
+"""
+Render a user's stored conversation as the compact transcript handed to the persona prompts.
+
+The transcript holds the conversation summary, the user details and the last `max_turns`
+question/answer pairs, newest kept first, within `token_budget` tokens. Timestamps, token
+counts and the rest of the stored message fields are left out. Renders are cached per
+(user, conversation version): every save bumps the version, so the next request renders again.
+"""
+import os
+import logging
+from typing import List, Optional
+from scripts.cache import TTLCache
+from scripts.metrics import register_cache
+from scripts.context_packing import count_tokens, truncate_sentences
+from workflows.states import ChatMessage, ConversationHistory
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TURNS = int(os.environ.get('HISTORY_TURNS', 6))
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', 600))
+# the summary gets at most this share of the budget, the rest is left to the recent turns
+SUMMARY_SHARE = 0.4
+NO_HISTORY = "No previous conversation."
+# the placeholder the persistence service stores before the first summarization
+NO_SUMMARY = "No summary available"
+
+RENDER_CACHE = TTLCache(maxsize=4096, ttl=3600)
+register_cache("rendered_history", RENDER_CACHE)
+
+
+def _turns(history: ConversationHistory) -> List[ChatMessage]:
+    # the messages kept by the last summarization come before the ones saved since
+    return (history.get("recent_messages") or []) + (history.get("full_history") or [])
+
+def _turn(message: ChatMessage) -> str:
+    return f"User: {message.get('user_message', '').strip()}\nAssistant: {message.get('ai_message', '').strip()}"
+
+def _details(history: ConversationHistory) -> Optional[str]:
+    details = {key: value for key, value in (history.get("user_details") or {}).items() if value}
+    if not details:
+        return None
+    return "About the user: " + "; ".join(f"{key}: {value}" for key, value in details.items())
+
+def render_history(history: Optional[ConversationHistory], max_turns: int = HISTORY_TURNS, token_budget: int = HISTORY_TOKEN_BUDGET) -> str:
+    """
+    The compact transcript of `history`.
+
+    Args:
+        history: the conversation as returned by `get_chat_history`
+        max_turns: most recent question/answer pairs kept
+        token_budget: tokens the transcript may take, the user details are always kept
+    """
+    if not history:
+        return NO_HISTORY
+
+    sections = []
+    remaining = token_budget
+    details = _details(history)
+    if details:
+        sections.append(details)
+        remaining -= count_tokens(details)
+
+    summary = (history.get("summary") or "").strip()
+    if summary and summary != NO_SUMMARY:
+        summary = truncate_sentences(summary, int(max(remaining, 0) * SUMMARY_SHARE))
+        if summary:
+            summary = f"Summary of the earlier conversation: {summary}"
+            sections.append(summary)
+            remaining -= count_tokens(summary)
+
+    # newest first until the budget runs out, rendered oldest first
+    turns = []
+    for message in reversed(_turns(history)[-max_turns:] if max_turns > 0 else []):
+        turn = _turn(message)
+        cost = count_tokens(turn)
+        if cost > remaining:
+            break
+        turns.append(turn)
+        remaining -= cost
+    if turns:
+        sections.append("Recent turns:\n" + "\n".join(reversed(turns)))
+
+    return "\n\n".join(sections) if sections else NO_HISTORY
+
+def cached_render_history(user_id: Optional[str], history: Optional[ConversationHistory]) -> str:
+    """
+    `render_history` with the default limits, cached per user until their conversation is saved again.
+    """
+    version = history.get("version") if history else None
+    if user_id is None or version is None:
+        return render_history(history)
+    key = (user_id, version)
+    rendered = RENDER_CACHE.get(key)
+    if rendered is None:
+        rendered = render_history(history)
+        RENDER_CACHE.set(key, rendered)
+    return rendered
@@ -1,85 +1,335 @@
-from scripts.embedding_service import PineconeEmbeddingManager
-from workflows.states import RAGState
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, List, Optional
+from scripts.cache import TTLCache
+from scripts.metrics import GRADING_PATHS, LLM_LATENCY, REWRITES, SPECULATIONS, register_cache, span
+from scripts.retrievers import Retriever, ScoredDocument
+from scripts.context_packing import SEPARATOR, assemble_context
+from workflows.states import RAGState, Speculation
+from workflows.history import cached_render_history
 from langchain_openai import ChatOpenAI
+from langchain_core.runnables import RunnableConfig
 
-def retrieve_documents(state: RAGState, retriever: PineconeEmbeddingManager) -> RAGState:
-    print('---RETRIEVING---')
-    prompt = state['prompt']
-    documents = retriever.search_matching(query=prompt)
+# relevance verdicts keyed by (prompt hash, document hash), repeat questions skip grading
+GRADE_CACHE = TTLCache(maxsize=4096, ttl=3600)
+register_cache("grades", GRADE_CACHE)
+GRADER_MAX_CONCURRENCY = 8
 
-    return {"prompt": prompt, "documents": documents}
+logger = logging.getLogger(__name__)
 
-def grade_documents(state: RAGState, document_grader: ChatOpenAI) -> RAGState:
-    print("---CHECK DOCUMENT RELEVANCE TO prompt---")
-    prompt = state['prompt']
-    documents = [f"{doc}" for doc in state['documents']]
+@dataclass
+class GradingPolicy:
+    """
+    Similarity-score thresholds that let clear-cut documents skip the LLM grader.
 
-    filtered_docs = []
-    score = document_grader.invoke({
-            "prompt": str(prompt),
-            "document": str(''.join(documents))
-        })
+    Attributes:
+        accept_score: documents scoring at least this are accepted without grading
+        reject_score: documents scoring below this are rejected without grading
+    """
+    accept_score: Optional[float] = None
+    reject_score: Optional[float] = None
+
+    def verdict(self, score: Optional[float]) -> Optional[bool]:
+        # None means the score is in the ambiguous band (or missing) and the LLM has to decide
+        if score is None:
+            return None
+        if self.accept_score is not None and score >= self.accept_score:
+            return True
+        if self.reject_score is not None and score < self.reject_score:
+            return False
+        return None
+
+DEFAULT_GRADING_POLICY = GradingPolicy()
+
+def _is_relevant(result: str) -> bool:
+    return ("'yes'" in result) or ("'Yes'" in result) or ("'YES'" in result) or ("yes" in result) or ("Yes" in result)
+
+def _generation_prompt(state: RAGState) -> str:
+    try:
+        _  = state['rewrite_count']
+        return state['rewritten_prompt']
+    except Exception as e:
+        return state['prompt']
+
+def retrieve_documents(state: RAGState, retriever: Retriever) -> RAGState:
+    logger.debug('---RETRIEVING---')
+    # after a rewrite, search with the rewritten prompt; `prompt` stays the user's question
+    prompt = _generation_prompt(state)
+    documents = retriever.search_matching(query=prompt)
 
-    result = score.binary_score
-    print(result)
-    if ("'yes'" in result) or ("'Yes'" in result) or ("'YES'" in result) or ("yes" in result) or ("Yes" in result):
-        print("---GRADE: DOCUMENT RELEVANT---")
-        filtered_docs.append(documents)
+    return {"documents": documents}
+
+async def aretrieve_documents(state: RAGState, retriever: Retriever) -> RAGState:
+    logger.debug('---RETRIEVING---')
+    prompt = _generation_prompt(state)
+    speculation = state.get('speculation')
+    if speculation and speculation.get('rewritten_prompt') == prompt and 'documents' in speculation:
+        logger.debug('---USING SPECULATIVE RETRIEVAL---')
+        documents = speculation['documents']
     else:
-        print("---GRADE: DOCUMENT NOT RELEVANT---")
-    
+        documents = await retriever.asearch_matching(query=prompt)
+
+    return {"documents": documents, "speculation": None}
+
+async def aspeculate_rewrite(state: RAGState, prompt_rewriter: ChatOpenAI, retriever: Optional[Retriever] = None, config: Optional[RunnableConfig] = None) -> Speculation:
+    """
+    Rewrite the prompt ahead of the grading verdict and, given a `retriever`, also retrieve for the rewrite.
+    """
+    source_prompt = _generation_prompt(state)
+    with span(LLM_LATENCY, "speculative_rewriter"):
+        rewritten_prompt = await prompt_rewriter.ainvoke({
+            "prompt": source_prompt
+        }, config=config)
+    speculation = {"source_prompt": source_prompt, "rewritten_prompt": rewritten_prompt}
+    if retriever is not None:
+        speculation["documents"] = await retriever.asearch_matching(query=rewritten_prompt)
+    return speculation
+
+def _context(state: RAGState) -> str:
+    # the packed context when the graph assembled one, the raw documents otherwise
+    texts = state.get('context')
+    if texts is None:
+        texts = [doc["text"] for doc in state["documents"]]
+    return SEPARATOR.join(texts)
+
+def _history(state: RAGState) -> str:
+    return cached_render_history(state.get("user_id"), state.get("conversation_history"))
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _initial_grades(prompt: str, documents: List[ScoredDocument], policy: GradingPolicy) -> List[Optional[bool]]:
+    """
+    Grade what can be graded without the LLM: by similarity score first, then from the memoized grades.
+    """
+    prompt_hash = _hash(prompt)
+    grades = []
+    for doc in documents:
+        grade = policy.verdict(doc.get("score"))
+        if grade is not None:
+            GRADING_PATHS.labels("accepted" if grade else "rejected").inc()
+        else:
+            grade = GRADE_CACHE.get((prompt_hash, _hash(doc["text"])))
+            if grade is not None:
+                GRADING_PATHS.labels("cached").inc()
+        grades.append(grade)
+    return grades
+
+def _filter_documents(prompt: str, documents: List[ScoredDocument], grades: List[Optional[bool]], missing: List[int], scores: list) -> RAGState:
+    prompt_hash = _hash(prompt)
+    GRADING_PATHS.labels("llm").inc(len(missing))
+    for i, score in zip(missing, scores):
+        if isinstance(score, Exception):
+            # a failed grade only drops its own document and is not memoized
+            logger.warning("---GRADE FAILED: %s---", score)
+            grades[i] = False
+            continue
+        grades[i] = _is_relevant(score.binary_score)
+        GRADE_CACHE.set((prompt_hash, _hash(documents[i]["text"])), grades[i])
+
+    filtered_docs = [doc for doc, relevant in zip(documents, grades) if relevant]
+    logger.debug("---GRADE: %d/%d DOCUMENTS RELEVANT---", len(filtered_docs), len(documents))
+
     return {"documents": filtered_docs, "prompt": prompt}
 
-def generate_response(state: RAGState, answer_generator: ChatOpenAI) -> RAGState:
-    print('---GENERATING RESPONSE---')
-    documents = state["documents"]
+def grade_documents(state: RAGState, document_grader: ChatOpenAI, max_concurrency: int = GRADER_MAX_CONCURRENCY, policy: GradingPolicy = DEFAULT_GRADING_POLICY) -> RAGState:
+    logger.debug("---CHECK DOCUMENT RELEVANCE TO prompt---")
+    prompt = state['prompt']
+    documents = state['documents']
+
+    # grade each document on its own so one irrelevant chunk doesn't sink the whole set
+    grades = _initial_grades(prompt, documents, policy)
+    missing = [i for i, grade in enumerate(grades) if grade is None]
+    scores = []
+    if missing:
+        with span(LLM_LATENCY, "document_grader"):
+            scores = document_grader.batch(
+                [{"prompt": str(prompt), "document": documents[i]["text"]} for i in missing],
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=True
+            )
+
+    return _filter_documents(prompt, documents, grades, missing, scores)
+
+async def agrade_documents(state: RAGState, document_grader: ChatOpenAI, config: Optional[RunnableConfig] = None, max_concurrency: int = GRADER_MAX_CONCURRENCY, policy: GradingPolicy = DEFAULT_GRADING_POLICY, speculation: Optional[Awaitable[Speculation]] = None) -> RAGState:
+    """
+    Async grading. A `speculation` (see `aspeculate_rewrite`) runs concurrently with the
+    grader: it is kept in the state when every document is rejected and cancelled otherwise.
+    """
+    logger.debug("---CHECK DOCUMENT RELEVANCE TO prompt---")
+    prompt = state['prompt']
+    documents = state['documents']
+
+    speculative_task = asyncio.ensure_future(speculation) if speculation is not None else None
     try:
-        _  = state['rewrite_count']
-        prompt = state['rewritten_prompt']
+        grades = _initial_grades(prompt, documents, policy)
+        missing = [i for i, grade in enumerate(grades) if grade is None]
+        scores = []
+        if missing:
+            with span(LLM_LATENCY, "document_grader"):
+                scores = await document_grader.abatch(
+                    [{"prompt": str(prompt), "document": documents[i]["text"]} for i in missing],
+                    config={**(config or {}), "max_concurrency": max_concurrency},
+                    return_exceptions=True
+                )
 
-    except Exception as e:
-        prompt = state['prompt']
+        result = _filter_documents(prompt, documents, grades, missing, scores)
+    except BaseException:
+        if speculative_task is not None:
+            speculative_task.cancel()
+        raise
+
+    if speculative_task is not None:
+        if result["documents"]:
+            speculative_task.cancel()
+            SPECULATIONS.labels("discarded").inc()
+        else:
+            try:
+                result["speculation"] = await speculative_task
+                SPECULATIONS.labels("used").inc()
+            except Exception as e:
+                # the rewriter node will rewrite the prompt itself
+                logger.warning("---SPECULATIVE REWRITE FAILED: %s---", e)
+                SPECULATIONS.labels("failed").inc()
+    return result
+
+def assemble_context_node(state: RAGState, token_budget: int = 1500, lambda_mult: float = 0.7, dedupe_threshold: float = 0.95) -> RAGState:
+    logger.debug('---ASSEMBLING CONTEXT---')
+    context = assemble_context(state["documents"], token_budget=token_budget, lambda_mult=lambda_mult, dedupe_threshold=dedupe_threshold)
+    logger.debug("---CONTEXT: %d/%d DOCUMENTS PACKED---", len(context), len(state["documents"]))
+
+    return {"context": context}
 
-    result = answer_generator.invoke({
-        "question": prompt,
-        "context": documents
-    })
+async def aassemble_context_node(state: RAGState, token_budget: int = 1500, lambda_mult: float = 0.7, dedupe_threshold: float = 0.95) -> RAGState:
+    # a few chunks of cpu work, not worth a thread hop
+    return assemble_context_node(state, token_budget=token_budget, lambda_mult=lambda_mult, dedupe_threshold=dedupe_threshold)
+
+def generate_response(state: RAGState, answer_generator: ChatOpenAI) -> RAGState:
+    logger.debug('---GENERATING RESPONSE---')
+    documents = _context(state)
+    prompt = _generation_prompt(state)
+
+    with span(LLM_LATENCY, "answer_generator"):
+        result = answer_generator.invoke({
+            "question": prompt,
+            "context": documents
+        })
 
     return {
-        "generation": result
+        "generation": result,
+        "rag_generation": result
+    }
+
+async def agenerate_response(state: RAGState, answer_generator: ChatOpenAI, config: Optional[RunnableConfig] = None) -> RAGState:
+    logger.debug('---GENERATING RESPONSE---')
+    documents = _context(state)
+    prompt = _generation_prompt(state)
+
+    with span(LLM_LATENCY, "answer_generator"):
+        result = await answer_generator.ainvoke({
+            "question": prompt,
+            "context": documents
+        }, config=config)
+
+    return {
+        "generation": result,
+        "rag_generation": result
     }
 
 def transform_query(state: RAGState, prompt_rewriter: ChatOpenAI) -> RAGState:
-    print('---REWRITTING---')
-   
-    try:
-        count  = state['rewrite_count']
-        prompt = state['rewritten_prompt']
-        result = prompt_rewriter.invoke({
-        "prompt": prompt
-        })
-        count += 1
-    except Exception as e:
-        prompt = state['prompt']
+    logger.debug('---REWRITTING---')
+    REWRITES.inc()
+
+    count = state.get('rewrite_count', 0) + 1
+    prompt = _generation_prompt(state)
+
+    with span(LLM_LATENCY, "prompt_rewriter"):
         result = prompt_rewriter.invoke({
-        "prompt": prompt
+            "prompt": prompt
         })
-        count = 1
+
+    return {"rewritten_prompt": result, "rewrite_count": count}
+
+async def atransform_query(state: RAGState, prompt_rewriter: ChatOpenAI, config: Optional[RunnableConfig] = None) -> RAGState:
+    logger.debug('---REWRITTING---')
+    REWRITES.inc()
+    count = state.get('rewrite_count', 0) + 1
+    prompt = _generation_prompt(state)
+
+    speculation = state.get('speculation')
+    if speculation and speculation.get('source_prompt') == prompt:
+        logger.debug('---USING SPECULATIVE REWRITE---')
+        return {"rewritten_prompt": speculation['rewritten_prompt'], "rewrite_count": count}
+
+    with span(LLM_LATENCY, "prompt_rewriter"):
+        result = await prompt_rewriter.ainvoke({
+            "prompt": prompt
+        }, config=config)
 
     return {"rewritten_prompt": result, "rewrite_count": count}
 
 def generate_assistant_response(state: RAGState, assistant: ChatOpenAI) -> RAGState:
-    print('---GENERATING ASSISTANT RESPONSE---')
+    logger.debug('---GENERATING ASSISTANT RESPONSE---')
     rag_generation = state['generation']
-    conversation_history = state["conversation_history"]
+    conversation_history = _history(state)
     original_prompt = state["prompt"]
 
-    result = assistant.invoke({
-        "generation": rag_generation,
-        "conversation_history": conversation_history,
-        "prompt": original_prompt
-    })
+    with span(LLM_LATENCY, "assistant"):
+        result = assistant.invoke({
+            "generation": rag_generation,
+            "conversation_history": conversation_history,
+            "prompt": original_prompt
+        })
 
     return {
         "generation": result
-    }
\ No newline at end of file
+    }
+
+async def agenerate_assistant_response(state: RAGState, assistant: ChatOpenAI, config: Optional[RunnableConfig] = None) -> RAGState:
+    logger.debug('---GENERATING ASSISTANT RESPONSE---')
+    rag_generation = state['generation']
+    conversation_history = _history(state)
+    original_prompt = state["prompt"]
+
+    with span(LLM_LATENCY, "assistant"):
+        result = await assistant.ainvoke({
+            "generation": rag_generation,
+            "conversation_history": conversation_history,
+            "prompt": original_prompt
+        }, config=config)
+
+    return {
+        "generation": result
+    }
+
+def generate_fused_response(state: RAGState, fused_assistant: ChatOpenAI) -> RAGState:
+    logger.debug('---GENERATING FUSED RESPONSE---')
+    documents = _context(state)
+
+    with span(LLM_LATENCY, "fused_assistant"):
+        result = fused_assistant.invoke({
+            "context": documents,
+            "conversation_history": _history(state),
+            "prompt": state["prompt"]
+        })
+
+    return {
+        "generation": result
+    }
+
+async def agenerate_fused_response(state: RAGState, fused_assistant: ChatOpenAI, config: Optional[RunnableConfig] = None) -> RAGState:
+    logger.debug('---GENERATING FUSED RESPONSE---')
+    documents = _context(state)
+
+    with span(LLM_LATENCY, "fused_assistant"):
+        result = await fused_assistant.ainvoke({
+            "context": documents,
+            "conversation_history": _history(state),
+            "prompt": state["prompt"]
+        }, config=config)
+
+    return {
+        "generation": result
+    }
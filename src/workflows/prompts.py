@@ -1,5 +1,4 @@
 from langchain_core.prompts import ChatPromptTemplate
-from langchain import hub
 
 REWRITER_PROMPT = ChatPromptTemplate.from_messages(
     [
@@ -39,11 +38,17 @@ ANSWER_PROMPT = ChatPromptTemplate.from_messages(
     ]
 )
 
-RAG_PROMPT = hub.pull("rlm/rag-prompt")
-
-FINAL_ANSWER_PROMPT = ChatPromptTemplate.from_messages(
+# a bundled copy of the rlm/rag-prompt hub prompt, so importing the prompts makes no network call
+RAG_PROMPT = ChatPromptTemplate.from_messages(
     [
-        ("system", """You are KAVAS, the AI assistant at Kifiya Technologies. Your responses must be:
+        ("human", """You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.
+Question: {question} 
+Context: {context} 
+Answer:"""),
+    ]
+)
+
+KAVAS_PERSONA = """You are KAVAS, the AI assistant at Kifiya Technologies. Your responses must be:
 1. Concise (2-4 sentences max) 
 2. Precise (focus on key information from the RAG response)
 3. Naturally human (use contractions, minimal pleasantries)
@@ -58,7 +63,11 @@ Bad example:
 "Kifiya is innovative... *long paragraph*... How can I assist you further today?"
 
 Good example: 
-"Kifiya leads Africa's fintech innovation through mobile banking solutions. Their recent partnership with Safaricom expanded services to Kenya - impressive progress! Need specifics on their tech?"""),
+"Kifiya leads Africa's fintech innovation through mobile banking solutions. Their recent partnership with Safaricom expanded services to Kenya - impressive progress! Need specifics on their tech?"""
+
+FINAL_ANSWER_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", KAVAS_PERSONA),
 
         ("human", """RAG response:  
 {generation}  
@@ -69,6 +78,26 @@ Conversation History:
 User's current question:  
 {prompt}  
 
+Respond in MAX 4 SENTENCES:""")
+    ]
+)
+
+# the RAG and persona prompts in one, used by the `fused` pipeline profile to answer in a single call
+FUSED_ANSWER_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", KAVAS_PERSONA + """
+
+Answer only from the retrieved context below. If it doesn't answer the question, say you don't have enough information."""),
+
+        ("human", """Retrieved context:  
+{context}  
+
+Conversation History:  
+{conversation_history}  
+
+User's current question:  
+{prompt}  
+
 Respond in MAX 4 SENTENCES:""")
     ]
 )
\ No newline at end of file
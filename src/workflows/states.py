@@ -1,5 +1,35 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 from typing_extensions import TypedDict
+from scripts.retrievers import ScoredDocument
+
+class ChatMessage(TypedDict, total=False):
+    """
+    A stored question/answer pair.
+    """
+    user_message: str
+    ai_message: str
+    timestamp: str
+    token_count: int
+    seq: int
+
+class ConversationHistory(TypedDict, total=False):
+    """
+    The stored conversation of a user, as loaded by the chat persistence service.
+
+    Attributes:
+        user_details: details about the user (name, job) extracted from the conversation
+        summary: the summary of the older messages
+        recent_messages: the messages kept unsummarized by the last summarization
+        full_history: the messages saved since the last summarization
+        type: "condensed" once a summary exists, "full" before
+        version: bumped by every write of the conversation
+    """
+    user_details: Dict[str, str]
+    summary: str
+    recent_messages: List[ChatMessage]
+    full_history: List[ChatMessage]
+    type: str
+    version: int
 
 class InputState(TypedDict):
     """
@@ -11,9 +41,22 @@ class InputState(TypedDict):
         prompt: question
     """
     user_id: Optional[str]
-    conversation_history: Optional[List[str]]
+    conversation_history: Optional[ConversationHistory]
     prompt: str
 
+class Speculation(TypedDict, total=False):
+    """
+    A rewrite (and retrieval) started while the documents were still being graded.
+
+    Attributes:
+        source_prompt: the prompt that was rewritten
+        rewritten_prompt: the prompt rewritten by the LLM
+        documents: the documents retrieved for the rewritten prompt, absent when only the rewrite is speculated
+    """
+    source_prompt: str
+    rewritten_prompt: str
+    documents: List[ScoredDocument]
+
 class IntermediateState(TypedDict):
     """
     Represents the intermediate state created during the RAG workflow that isn't of importance to the user
@@ -22,14 +65,18 @@ class IntermediateState(TypedDict):
         prompt: question
         rewritten_prompt: the prompt rewritten by the LLM
         generation: LLM generation
-        documents: list of documents
+        documents: list of retrieved documents with their similarity scores
         rewrite_count: the number of rewrites of the query
+        speculation: the speculative rewrite to reuse if the documents are rejected
+        context: the de-duplicated chunk texts packed into the context budget, in the order given to the model
     """
     prompt: str
     rewritten_prompt: str
     generation: str
-    documents: List[str]
+    documents: List[ScoredDocument]
     rewrite_count: int
+    speculation: Optional[Speculation]
+    context: List[str]
 
 class OutputState(TypedDict):
     """
@@ -37,8 +84,10 @@ class OutputState(TypedDict):
 
     Attributes:
         generation: the LLM generated response
+        rag_generation: the answer of the RAG stage, before the persona rewrote it (absent with the fused profile)
     """
     generation: str
+    rag_generation: Optional[str]
 
 class RAGState(InputState, IntermediateState, OutputState):
     """